@@ -31,9 +31,10 @@ import communication.protocols.ShufflingProtocol as shuffle
 import communication.protocols.TransactionProtocol as transaction
 
 from communication.protocols.state.BaseState import mstate, BaseState
+from communication.protocols.low.ParallelDecryption import startPool
 
 from twisted.internet import reactor
-from twisted.internet.defer import DeferredList
+from twisted.internet.defer import Deferred, DeferredList
 from twisted.python.failure import Failure
 from configobj import ConfigObj
 from os.path import isfile
@@ -70,11 +71,15 @@ class MixingPeer():
             return state.getP2pServer().shutdown()
 
         def _removeState(_, state):
-            mstate.removeState(state)
+            # Drop all running rounds of the mixnet
+            for round_state in state.rounds.getStates():
+                if (round_state in mstate.getStates()):
+                    mstate.removeState(round_state)
             if (len(mstate.getStates()) == 0):
                 self.realShutdown()
         state = mstate.getState(mixnet_id)
-        state.setShutdownFlag()
+        for round_state in state.rounds.getStates():
+            round_state.setShutdownFlag()
         cd = state.getP2pClient().shutdown()
         cd.addCallback(_serverShutdown)
         cd.addCallback(_removeState, state=state)
@@ -89,8 +94,8 @@ class MixingPeer():
             ))
         elif (isinstance(failure, BaseException)):
             log.error('Shutting down due to error: {}'.format(str(failure)))
-        for state in mstate.getStates():
-            self.localShutdown(None, state.mixnet.getMixnetID())
+        for mixnet_id in set(state.mixnet.getMixnetID() for state in mstate.getStates()):
+            self.localShutdown(None, mixnet_id)
 
     def realShutdown(self):
         def _finishShutdown(_):
@@ -102,6 +107,66 @@ class MixingPeer():
     def cancelOperation(self, operation_deferred):
         operation_deferred.cancel()
 
+    def runRound(self, state, mixnet_deferreds):
+        """ Chain the phases of one mixing round to the given deferred. """
+        mixnet_deferreds.addCallback(
+            DeferredLogger.debug, msg='Trying to start initialization of round ' + str(state.getRound()) + '.'
+        )
+        mixnet_deferreds.addCallback(init.initialize, state=state)
+        mixnet_deferreds.addCallback(
+            DeferredLogger.debug, msg='Trying to start escrow generation.'
+        )
+        mixnet_deferreds.addCallback(escrow.generate_escrows, state=state)
+        mixnet_deferreds.addCallback(
+            DeferredLogger.debug, msg='Trying to start commitment phase.'
+        )
+        mixnet_deferreds.addCallback(commit.commitment_phase, state=state)
+        mixnet_deferreds.addCallback(self.overlapRound, state=state)
+        mixnet_deferreds.addCallback(
+            DeferredLogger.debug, msg='Trying to start shuffling phase.'
+        )
+        mixnet_deferreds.addCallback(shuffle.shuffling_phase, state=state)
+        mixnet_deferreds.addCallback(
+            DeferredLogger.debug, msg='Trying to start transaction phase.'
+        )
+        mixnet_deferreds.addCallback(
+            transaction.transaction_phase, state=state
+        )
+        mixnet_deferreds.addCallback(self.concludeRound, state=state)
+
+        """ Add graceful shutdown as a errback """
+        mixnet_deferreds.addErrback(self.globalShutdown)
+
+        error_deferred = state.getErrorDeferred()
+        error_deferred.addBoth(
+            self.cancelOperation,
+            operation_deferred=mixnet_deferreds
+        )
+        return mixnet_deferreds
+
+    def startRound(self, mixnet_id):
+        state = mstate.renewState(mixnet_id)
+        log.info('Starting round ' + str(state.getRound()) + ' of mixnet ' + str(mixnet_id) + '.')
+        round_deferred = Deferred()
+        self.runRound(state, round_deferred)
+        round_deferred.callback(None)
+
+    def overlapRound(self, v, state):
+        """ The round no longer accepts input peers, hence the commitment
+            window of the next round may already be opened while this one
+            is shuffling and streaming its payouts. """
+        if (state.rounds.requestRound()):
+            self.startRound(state.mixnet.getMixnetID())
+        return v
+
+    def concludeRound(self, v, state):
+        """ Archive the state of a concluded round, so that its input peers
+            can still review it, and start a pending round. """
+        log.info('Concluded round ' + str(state.getRound()) + ' of mixnet ' + str(state.mixnet.getMixnetID()) + '.')
+        if (mstate.archiveState(state)):
+            self.startRound(state.mixnet.getMixnetID())
+        return v
+
     def __init__(self, id, mixnet_config):
         """ Create a new mixing peer.
 
@@ -137,6 +202,13 @@ class MixingPeer():
 
         mstate.setMixpeerID(id)
 
+        """ Fork the decryption workers before any connection is opened. """
+        try:
+            startPool(mstate.getDecryptionWorkers(), me['prvkey'], me['pubkey'])
+        except KeyError:
+            log.error('Could not read my cryptography parameters. Shutting down.')
+            sys.exit(1)
+
         # Load all necessary addresses
         try:
             web_port = int(me['web_addr'].split(':')[1])
@@ -161,7 +233,16 @@ class MixingPeer():
                 log.error('Could not find my p2p address in some mixnet. Shutting down.')
                 sys.exit(1)
 
-            state = BaseState(rank, mixnet_id, len(mixnet))
+            state = BaseState(
+                rank,
+                mixnet_id,
+                len(mixnet),
+                nonces_per_escrow=mstate.getNoncesPerEscrow(),
+                batch_interval=mstate.getBatchInterval(),
+                fee_bump_blocks=mstate.getFeeBumpBlocks(),
+                open_checksums_early=mstate.opensChecksumsEarly(),
+                concurrent_rounds=mstate.getConcurrentRounds()
+            )
             mstate.appendState(state)
 
             # Read EC keys and create encryption "endpoint"
@@ -212,45 +293,10 @@ class MixingPeer():
                 then start the operations """
             p2p_deferred = self.startP2pInfrastructure(state, p2p_server_port)
             mixnet_deferreds = DeferredList([webserver_deferred, p2p_deferred])
-            mixnet_deferreds.addCallback(
-                DeferredLogger.debug, msg='Trying to start initialization.'
-            )
-            mixnet_deferreds.addCallback(init.initialize, state=state)
-            mixnet_deferreds.addCallback(
-                DeferredLogger.debug, msg='Trying to start escrow generation.'
-            )
-            mixnet_deferreds.addCallback(escrow.generate_escrows, state=state)
-            mixnet_deferreds.addCallback(
-                DeferredLogger.debug, msg='Trying to start commitment phase.'
-            )
-            mixnet_deferreds.addCallback(commit.commitment_phase, state=state)
-            mixnet_deferreds.addCallback(
-                DeferredLogger.debug, msg='Trying to start shuffling phase.'
-            )
-            mixnet_deferreds.addCallback(shuffle.shuffling_phase, state=state)
-            mixnet_deferreds.addCallback(
-                DeferredLogger.debug, msg='Trying to start transaction phase.'
-            )
-            mixnet_deferreds.addCallback(
-                transaction.transaction_phase, state=state
-            )
-            mixnet_deferreds.addCallback(
-                DeferredLogger.critical, msg='Not implemented past this point!'
-            )
-
-            """ Add graceful shutdown as a errback """
-            mixnet_deferreds.addErrback(self.globalShutdown)
 
-            """ TODO: At this point, the state SHOULD be renewed (and the old
-                one should be archived for other peers to review their
-                operation) to allow for a subsequent new mixing without
-                re-establishing the connection between peers. """
-
-            error_deferred = state.getErrorDeferred()
-            error_deferred.addBoth(
-                self.cancelOperation,
-                operation_deferred=mixnet_deferreds
-            )
+            """ Subsequent rounds are started by the round itself, reusing
+                the connections between peers (see overlapRound). """
+            self.runRound(state, mixnet_deferreds)
 
         log.info('Initialized mixing peer.')
         log.info('Running event listener now. Bye!')
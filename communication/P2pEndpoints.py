@@ -86,12 +86,12 @@ class P2pServer(object):
             self.address_provided = False
             MsgReceiver.__init__(self)
 
-        def getBroadcastTransaction(self, msg):
+        def getBroadcastTransaction(self, msg, state):
             """ If any broadcast message is received, try to match it again
                 an already established state. """
 
             # Look up the msg's sequence number for a pending transaction
-            transaction = self.state.transactions.findTransaction(msg['seq'])
+            transaction = state.transactions.findTransaction(msg['seq'])
 
             # If no transaction is found, establish a state and start replying
             if (transaction is None):
@@ -104,33 +104,33 @@ class P2pServer(object):
                     msg_type = req.MessageHandler.getMessageType(msg['m'])
                     request_handler = req.getMessageHandler(msg_type)
                     transaction = ConsistentBroadcastTransaction(
-                        self.state.mixnet.getRank(),
-                        self.state.crypto.getCrypter(),
-                        self.state.mixnet.getConnectedMixpeers(),
-                        self.state.mixnet.getMixnetSize(),
-                        self.state.mixnet.getMixpeerThreshold(),
+                        state.mixnet.getRank(),
+                        state.crypto.getCrypter(),
+                        state.mixnet.getConnectedMixpeers(),
+                        state.mixnet.getMixnetSize(),
+                        state.mixnet.getMixpeerThreshold(),
                         msg['seq'],
                         None,
-                        self.state.getP2pClientDeferred()
+                        state.getP2pClientDeferred()
                     )
                 elif (msg['msg'] == 'rbrc'):
                     raise RuntimeError('Reliable broadcast is not implemented yet.')
                 else:
                     raise RuntimeError('Unknwon broadcast type')
-                self.state.transactions.addTransaction(transaction)
+                state.transactions.addTransaction(transaction)
                 if (msg_type in req.MessageTypes.smpc_msgs):
                     smpc_msg = request_handler.decode(msg['m'])
-                    smpc_value = self.state.smpc.getValue(smpc_msg['id'], smpc_msg['index'])
+                    smpc_value = state.smpc.getValue(smpc_msg['id'], smpc_msg['index'])
                     if (smpc_value is None):
-                        smpc_value = self.state.smpc.newValue(
+                        smpc_value = state.smpc.newValue(
                             smpc_msg['alg'],
-                            self.state,
+                            state,
                             smpc_msg['id'],
                             smpc_msg['index']
                         )
                     transaction.defineCallback(request_handler, smpc_value)
                 else:
-                    transaction.defineCallback(request_handler, self.state)
+                    transaction.defineCallback(request_handler, state)
             return transaction
 
         def msgReceived(self, msg_bin):
@@ -146,23 +146,30 @@ class P2pServer(object):
             if (request_handler is None):
                 return
 
+            # Route the message to the mixing round it belongs to
+            round = req.MessageHandler.getRound(msg_bin)
+            state = self.state.rounds.getState(round)
+            if (state is None):
+                log.warning('Ignoring message of unknown round ' + str(round) + '.')
+                return
+
             msg = request_handler.decode(msg_bin)
 
             if (msg_type in req.MessageTypes.brdc_msgs):
-                transaction = self.getBroadcastTransaction(msg)
-                result = request_handler.processRequest(msg, transaction, self.state)
+                transaction = self.getBroadcastTransaction(msg, state)
+                result = request_handler.processRequest(msg, transaction, state)
             elif (msg_type in req.MessageTypes.smpc_msgs):
-                smpc_value = self.state.smpc.getValue(msg['id'], msg['index'])
+                smpc_value = state.smpc.getValue(msg['id'], msg['index'])
                 if (smpc_value is None):
-                    smpc_value = self.state.smpc.newValue(
+                    smpc_value = state.smpc.newValue(
                         msg['alg'],
-                        self.state,
+                        state,
                         msg['id'],
                         msg['index']
                     )
                 result = request_handler.processRequest(msg, smpc_value)
             else:
-                result = request_handler.processRequest(msg, self.state)
+                result = request_handler.processRequest(msg, state)
             if (result is not None):
                 response = result
                 self.respond(response)
@@ -249,7 +256,8 @@ class P2pClient(object):
             except BaseException as e:
                 log.critical('Got error: ' + str(e) + '. Shutting down mixnet entirely.')
                 self.factory.shutdown_deferred.callback(self)
-                self.state.triggerErrorDeferred(e)
+                for state in self.state.rounds.getStates():
+                    state.triggerErrorDeferred(e)
                 return
             self.factory.shutdown_deferred.callback(self)
 
@@ -280,8 +288,15 @@ class P2pClient(object):
                 print('Request Handler is none')
                 return
 
+            # Responses are matched against the transactions of their round
+            round = req.MessageHandler.getRound(msg_bin)
+            state = self.state.rounds.getState(round)
+            if (state is None):
+                log.warning('Ignoring response of unknown round ' + str(round) + '.')
+                return
+
             msg = request_handler.decode(msg_bin)
-            self.state.transactions.receivedMessage(msg)  # This implicitly fires deferreds once everything is received
+            state.transactions.receivedMessage(msg)  # This implicitly fires deferreds once everything is received
             return
 
     class P2pClientFactory(protocol.ClientFactory):
@@ -343,50 +358,53 @@ class P2pClient(object):
     def response_helo(self, response, value, is_positive, opt):
         log.debug('Entered helo result fetcher')
         result = dict()
-        input_peer = opt
+        (input_peer, state) = opt
         try:
             rank = int(response['rank'])
         except KeyError:
-            self.state.input.createSessionError(input_peer['session_id'], None, 'rank_missing')
+            state.input.createSessionError(input_peer['session_id'], None, 'rank_missing')
         acked = self.isAcked(response)
         result['value'] = input_peer
         result['is_positive'] = acked
         input_peer['report'][rank] = acked
         return result
 
-    def request_helo_callback(self, input_peer, encrypted_output_address):
+    def request_helo_callback(self, input_peer, encrypted_output_address, state):
 
         # Create session ID
         session_id_string = str(random.getrandbits(128))
         h = hashlib.sha256()
         h.update(session_id_string)
         session_id = h.hexdigest()
-        input_peer['session_id'] = session_id
+        state.input.setSessionID(input_peer, session_id)
 
         # Store output address
-        self.state.input.addOutputAddress(encrypted_output_address)
+        state.input.addOutputAddress(encrypted_output_address)
 
-        self.state.input.clearReports(input_peer['id'])
+        state.input.clearReports(input_peer['id'])
 
-        seq = self.state.transactions.getNextSequenceNumber()
-        msg = req.helo.encode(self.state.mixnet.getRank(), seq, self.state.crypto.getCrypter(), input_peer, encrypted_output_address)
-        peers = self.state.mixnet.getConnectedMixpeers()
+        seq = state.transactions.getNextSequenceNumber()
+        msg = req.helo.encode(state.mixnet.getRank(), seq, state.crypto.getCrypter(), input_peer, encrypted_output_address)
+        peers = state.mixnet.getConnectedMixpeers()
         # Create deferred for broadcast, fired after the last response is received
-        broadcast_deferred = self.state.transactions.addTransaction(
-            BroadcastTransaction(self.state.mixnet.getRank(), peers, msg, seq, self.response_helo, input_peer)
+        broadcast_deferred = state.transactions.addTransaction(
+            BroadcastTransaction(state.mixnet.getRank(), peers, msg, seq, self.response_helo, (input_peer, state))
         )
-        broadcast_deferred.addCallback(self.state.commit.checkInputPeerThreshold)
+        broadcast_deferred.addCallback(state.commit.checkInputPeerThreshold)
         return broadcast_deferred
 
-    def request_helo(self, encrypted_output_address):
+    def request_helo(self, encrypted_output_address, state=None):
+        """ Register a new input peer with the given mixing round, which
+            defaults to the round the client was created for. """
+        state = self.state if (state is None) else state
         address_deferred = Deferred()
 
         address_deferred.addErrback(self.request_new_addresses)
-        address_deferred.addCallback(self.request_helo_callback, encrypted_output_address=encrypted_output_address)
+        address_deferred.addCallback(self.request_helo_callback, encrypted_output_address=encrypted_output_address, state=state)
 
         # Assign new address
-        input_peer = self.state.input.addInputPeer()
-        self.state.commit.increasePeerCount()
+        input_peer = state.input.addInputPeer()
+        state.commit.increasePeerCount()
         if (input_peer is not None):
             log.debug('I\'m going to request new addresses...')
             address_deferred.errback(5)
@@ -171,7 +171,7 @@ def getSessionData(pageobj, input_peer, content):
     pageobj.replacements.update({
         '\#cp\_sid\#'      : str(input_peer['session_id']),
         '\#cp\_escrow\#'   : str(input_peer['address']),
-        '\#cp\_value\#'    : str(pageobj.state.getBitcoinValue() + pageobj.state.getTransactionFee()),
+        '\#cp\_value\#'    : str(pageobj.state.getCommitmentValue()),
         '\#cp\_feeless\#'  : str(pageobj.state.getBitcoinValue()),
         '\#cp\_report\#'   : reports_empty,
         '\#cp\_timestr\#'  : time_string,
@@ -422,7 +422,7 @@ class initiateMixing(htmlParser):
         })
 
         self.request = request
-        d = self.state.getP2pClient().request_helo(request.args['output'][0].decode('hex'))
+        d = self.state.getP2pClient().request_helo(request.args['output'][0].decode('hex'), state=self.state)
         d.addCallback(self.render_response)
         return NOT_DONE_YET
 
@@ -21,7 +21,10 @@
     You should have received a copy of the GNU General Public License
     along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
 
-from low.CoinPartyProxy import bitcoind, transaction_confirmed
+from low.CoinPartyProxy import bitcoind, chain_scanner
+from low.CommitmentWatcher import CommitmentWatcher
+from low.ChainNotifier import getChainNotifier
+from ShufflingProtocol import prepareChecksums
 from state.BaseState import mstate
 import ErrorProtocol as errorrev
 
@@ -30,6 +33,10 @@ from twisted.internet.defer import Deferred, DeferredList
 from low.log import Logger, DeferredLogger
 log = Logger('commit')
 
+""" Commitments are polled for on each new block. Periodical polling is only
+    a fallback in case notifications get lost. """
+FALLBACK_POLLING_INTERVAL = 60
+
 
 def commitment_phase(_, state):
     """ Implements the protocol flow of the commitment phase of CoinParty. """
@@ -83,19 +90,16 @@ def commitment_phase(_, state):
             if (input_peer is None):
                 raise ValueError('escrow_not_found')
 
-            # Remove escrow address from unseen list
-            escrow_index = state.input._unseen_tx_escrow_addresses.index(address)
-            del state.input._unseen_tx_escrow_addresses[escrow_index]
+            # Escrow is no longer unseen, the transaction awaits its confirmations
+            state.input.getCommitmentTracker().seen(address, txid)
 
             # Add txid information to input peer
             log.debug('Found transaction ' + txid)
             log.debug('...assigned to user ' + str(input_peer['id']))
-            input_peer['txid'] = txid
-            input_peer['tx_vout'] = vout
-            state.input._unconfirmed_transactions.append(txid)
+            state.input.setCommitment(input_peer, txid, vout)
 
             # If the value is wrong, try and repair this
-            if (value != state.getBitcoinValue() + state.getTransactionFee()):
+            if (value != state.getCommitmentValue()):
                 log.warning('Wrong input. Refunding.')
                 eligible = errorrev.returnFunds(txid, address, state._bitcoin_value)
                 if (not eligible):
@@ -103,78 +107,37 @@ def commitment_phase(_, state):
                     raise RuntimeError('wrong_value')
             return
 
-        def _poll_new_transactions(addresses, block_hash):
-            """ Poll bitcoind for those addresses that occured since the block
-                referred to by the last block hash. """
-
-            def has_next_block(block):
-                return True if 'nextblockhash' in block else False
-
-            def filter_transactions(txs):
-                """ Directly filter out the information we need """
-
-                def _filter_transaction(tx):
-                    result = []
-                    for i in xrange(0, len(tx['vout'])):
-                        filtered_tx = dict()
-                        filtered_tx['txid'] = tx['txid']
-                        filtered_tx['addr'] = tx['vout'][i]['scriptPubKey']['addresses'][0]
-                        filtered_tx['vout'] = int(tx['vout'][i]['n'])
-                        filtered_tx['value'] = tx['vout'][i]['value']
-                        filtered_tx['blockhash'] = tx['blockhash']
-                        result.append(filtered_tx)
-                    return result
-
-                filtered_txs = []
-                for tx in txs:
-                    if (tx is None):
-                        # In the testnet, transactions may apparently be broken
-                        if (mstate.usingTestnet()):
-                            log.warning('Found invalid transaction in testnet.')
-                            continue
-                        else:
-                            raise RuntimeError('invalid_transaction')
-
-                    # If transaction is not in the format we expect, it's definitely not one we care about
-                    try:
-                        filtered_tx = _filter_transaction(tx)
-                        filtered_txs += filtered_tx
-                    except KeyError:
-                        continue
-                return filtered_txs
-
-            def get_transactions(block):
-                txids = block['tx']
-                txs = filter_transactions([bitcoind.getrawtransaction(txid) for txid in txids])
-                return txs
-
-            new_txs = []
-            current_block = bitcoind.getblock(block_hash)
-            while (has_next_block(current_block)):
-                log.info('Checking block ' + current_block['hash'] + '...')
-                transactions = get_transactions(current_block)
-                for tx in transactions:
-                    if (tx['addr'] in addresses):
-                        log.info('Found transaction to "' + tx['addr'] + '"!')
-                        log.info('txid: ' + tx['txid'] + '; value: ' + str(tx['value']))
-                        new_txs.append(tx)
-                current_block = bitcoind.getblock(current_block['nextblockhash'])
-            return (new_txs, current_block['hash'])
+        def _poll_new_transactions():
+            """ Let the chain scanner catch up with the best block chain and
+                fetch those transactions it found to our unseen escrows. """
+            block_hash = chain_scanner.scan()
+            return (state.commit.getCommitmentWatcher().popFoundTransactions(), block_hash)
 
         def _poll_tx_confirmations(txids, confirmations=6):
-            """ Poll the Bitcoin network for confirmations of already seen CoinParty transactions. """
+            """ Derive the confirmations of already seen CoinParty transactions
+                from the height of the blocks including them. The chain
+                scanner already followed the best block chain, hence this
+                does not require to query bitcoind.
+                Return (txid, height) of the confirmed transactions, where
+                height is that of the block that confirmed them sufficiently
+                often, which is the same on all mixing peers. """
+            watcher = state.commit.getCommitmentWatcher()
             result = []
             for txid in txids:
-                if transaction_confirmed(txid=txid, confirmations=confirmations):
-                    result.append(txid)
+                (block_hash, height) = watcher.getInclusion(txid)
+                if (chain_scanner.getConfirmations(block_hash, height) >= confirmations):
+                    watcher.untrack(txid)
+                    result.append((txid, height + confirmations - 1))
             return result
 
         log.debug('Polling...')
-        unseen_escrows = state.getUnseenTransactionEscrows()
-        if (len(unseen_escrows) > 0):
-            log.debug('Looking for transactions to: ' + str(unseen_escrows))
-            (new_txs, blockhash) = _poll_new_transactions(unseen_escrows, state.getLastBlockHash())
-            state.setLastBlockHash(blockhash)
+        tracker = state.input.getCommitmentTracker()
+        if (tracker.getNumberUnseen() > 0):
+            log.debug('Looking for transactions to ' + str(tracker.getNumberUnseen()) + ' escrows.')
+        # Scan even if all commitments were found, as this also keeps track of confirmations
+        (new_txs, blockhash) = _poll_new_transactions()
+        state.setLastBlockHash(blockhash)
+        if (len(new_txs) > 0):
             for tx in new_txs:
                 _found_transaction(
                     tx['addr'],
@@ -182,21 +145,42 @@ def commitment_phase(_, state):
                     tx['txid'],
                     tx['vout']
                 )
-            if (state.input.inputPeersFrozen() and len(state.getUnseenTransactionEscrows()) == 0):
+            if (state.input.inputPeersFrozen() and tracker.getNumberUnseen() == 0):
                 log.debug('Found all transactions. From now on, I just wait for their confirmation.')
 
         new_confirmed_txids = _poll_tx_confirmations(state.getUnconfirmedTransactions())
-        for txid in new_confirmed_txids:
-            state.foundCommitment(txid)
+        for (txid, height) in new_confirmed_txids:
+            state.foundCommitment(txid, height)
 
         if (state.allPaymentsReceived()):
             log.info('All input peers commited their coins!')
             state.commit.firePollingDeferred()
         return
 
+    def _new_block_notification(event, data):
+        """ Look for commitments as soon as a new block arrives. """
+        if (event == 'block'):
+            log.debug('New block ' + str(data) + '. Triggering poll.')
+            state.commit.triggerPolling()
+        return
+
+    def _stop_watching(v, notifier, watcher):
+        notifier.unsubscribe(_new_block_notification)
+        chain_scanner.unregister(watcher)
+        return v
+
     """ Begin of the actual commitment phase definition. """
 
     state.setLastBlockHash(_obtain_initial_blockhash())
+    watcher = CommitmentWatcher(
+        bitcoind,
+        mstate.watchingAddresses(),
+        state.getUnseenTransactionEscrows,
+        lambda a: state.input.getInputPeer('address', a)['script_pubkey'],
+        state.input.getCommitmentTracker().getVersion
+    )
+    state.commit.setCommitmentWatcher(watcher)
+    chain_scanner.register(watcher, state.getLastBlockHash())
     state.commit.startPeerGathering()
 
     threshold_deferred = state.commit.getThresholdDeferred()
@@ -204,14 +188,19 @@ def commitment_phase(_, state):
     threshold_deferred.addCallback(_fire_freezing_deferred)
     threshold_deferred.addCallback(_wait_for_hash_shares)
     threshold_deferred.addCallback(_replace_hash_shares)
+    threshold_deferred.addCallback(prepareChecksums, state=state)
     threshold_deferred.addErrback(DeferredLogger.error, msg='Error in threshold deferred: ')
 
     polling_deferred = state.commit.setPollingDeferred(
         _poll_for_commitments,
-        10
+        FALLBACK_POLLING_INTERVAL
     )
     polling_deferred.addErrback(DeferredLogger.error, 'Error in polling deferred: ')
 
+    notifier = getChainNotifier()
+    notifier.subscribe(_new_block_notification)
+    polling_deferred.addBoth(_stop_watching, notifier=notifier, watcher=watcher)
+
     log.info('Unblocking web server.')
     state.unblockWebServer()
 
@@ -25,6 +25,7 @@ from twisted.internet.defer import Deferred, DeferredList
 
 import low.Bitcoin as bcc
 from low.smpc.base import invert
+from low.constants import bitcoin_order
 from state.BaseState import mstate
 
 from low.log import Logger, DeferredLogger
@@ -119,12 +120,12 @@ def generate_escrows(_, state, amount=3):
             log.error('Error message: ' + str(e))
             raise RuntimeError(str(e))
 
-    def compute_k_inv_d_share(k_inv_deferred, d_deferred, index):
+    def compute_k_inv_d_share(k_inv_deferred, d_deferred, index, nonce_index):
         """ Compute the share of k^-1 * d """
         def calc(list):
-            k_inv_share = state.smpc.getValue('ki', index)
+            k_inv_share = state.smpc.getValue('ki', nonce_index)
             d_share = state.smpc.getValue('d', index)
-            k_inv_d_share = state.smpc.newValue('mul', state, 'kid', index)
+            k_inv_d_share = state.smpc.newValue('mul', state, 'kid', nonce_index)
             return k_inv_d_share.initialize(k_inv_share, d_share)
         try:
             sync = DeferredList([k_inv_deferred, d_deferred])
@@ -135,6 +136,34 @@ def generate_escrows(_, state, amount=3):
             log.error('Error message: ' + str(e))
             raise RuntimeError(str(e))
 
+    def compute_signing_context(k_inv_d_deferred, index):
+        """ Pre-compute everything needed to sign using the nonce k:
+            R = kG, r = R.x mod n and the share of r * k^-1 * d """
+
+        def get_R(_):
+            return state.smpc.getValue('k', index).getPublicValue()
+
+        def calc(R):
+            r = R.x() % bitcoin_order
+            k_inv_share = state.smpc.getValue('ki', index).getSecretShare()
+            r_k_inv_d_share = state.smpc.newValue('cmul', state, 'rkid', index)
+            shares = DeferredList([k_inv_share, r_k_inv_d_share.initialize(r, state.smpc.getValue('kid', index))])
+            shares.addCallback(store, R=R, r=r)
+            return shares
+
+        def store(shares, R, r):
+            state.signing.storeContext(index, R, r, shares[0][1], shares[1][1])
+            return
+
+        try:
+            k_inv_d_deferred.addCallback(get_R)
+            k_inv_d_deferred.addCallback(calc)
+            return k_inv_d_deferred
+        except BaseException as e:
+            log.error('Failed computing signing context.')
+            log.error('Error message: ' + str(e))
+            raise RuntimeError(str(e))
+
     def fire_deferred(_, deferred):
         deferred.callback(None)
         return
@@ -145,20 +174,32 @@ def generate_escrows(_, state, amount=3):
         state.input.storeGeneratedEscrow(index, public_key, bitcoin_address)
         return
 
+    def create_nonce(d, i, nonce_index):
+        """ Pre-compute one nonce of escrow i and its signing context. The
+            values of the nonce are stored at nonce_index. """
+        k = generate_k_and_kG(nonce_index)
+        k.addErrback(DeferredLogger.error, msg='Could not run k callback chain')
+
+        k_inv = compute_k_inv_share(k, nonce_index)
+        k_inv_d = compute_k_inv_d_share(k_inv, d, i, nonce_index)
+        k_inv.addErrback(DeferredLogger.error, msg='Could not run k_inv callback chain')
+        context = compute_signing_context(k_inv_d, nonce_index)
+        context.addErrback(DeferredLogger.error, msg='Could not run signing context callback chain')
+        return DeferredList([k, k_inv, context])
+
     def create_escrow(_, i):
         d = generate_private_key_share_and_public_key(i)
         d.addCallback(compute_pubkey_address, using_testnet=mstate.usingTestnet())
         d.addCallback(store_address, i=i)
         d.addErrback(DeferredLogger.error, msg='Could not run callback chain')
 
-        k = generate_k_and_kG(i)
-        k.addErrback(DeferredLogger.error, msg='Could not run k callback chain')
-
-        k_inv = compute_k_inv_share(k, i)
-        k_inv_d = compute_k_inv_d_share(k_inv, d, i)
-        k_inv.addErrback(DeferredLogger.error, msg='Could not run k_inv callback chain')
+        # Each nonce allows for signing one output transaction of the escrow
+        nonces = [
+            create_nonce(d, i, state.signing.getNonceIndex(i, j))
+            for j in xrange(0, state.signing.getNoncesPerEscrow())
+        ]
 
-        sync_point = DeferredList([d, k, k_inv, k_inv_d])
+        sync_point = DeferredList([d] + nonces)
         sync_point.addCallback(store_escrow, index=i)
         return sync_point
 
@@ -22,15 +22,72 @@ from low.constants import hash_order, hash_modulus
 import low.Requests as req
 from low.Transaction import BroadcastTransaction
 from low.smpc.WrapperSmpcValue import WrapperSmpcValue
+from low.ParallelDecryption import decryptAddresses
+from low.AddressArray import AddressArray
 import hashlib
 from Crypto.Random.Fortuna.FortunaGenerator import AESGenerator as SeedablePrngGenerator
 from Crypto.Random.random import StrongRandom
 from Crypto.Random import random
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, DeferredList
+from array import array
 
 from low.log import Logger
 log = Logger('shuffling')
 
+""" Number of addresses per addr message. """
+ADDR_CHUNK_SIZE = 256
+
+
+def checksumToString(checksum):
+    return '{0:0{1}x}'.format(int(checksum) % hash_modulus, 64)
+
+
+def computeHashShareSums(escrows, state):
+    """ Sum up the escrows' hash shares of each layer in a single pass. """
+    sums = [0] * state.mixnet.getMixnetSize()
+    for escrow in escrows:
+        for layer in xrange(0, len(sums)):
+            sums[layer] = (sums[layer] + escrow['hash_share'][layer]) % hash_order
+    return sums
+
+
+def prepareChecksums(escrows, state):
+    """ Called once the set of escrows is frozen and their hash shares are
+        known. Precompute the sums of hash shares, so that only the opening
+        of the checksums remains for each hop.
+        If enabled, the checksums of all layers are even opened right away
+        within a single vector recombination. Note that this weakens the
+        verification of the shuffle: the checksum of a layer is then known
+        before the corresponding mixing peer broadcasts its addresses, which
+        may help a malicious peer to find a manipulated array of addresses
+        that matches the checksum. Hence, this mode is disabled by default. """
+    def _store_checksums(checksums):
+        for layer in xrange(0, len(checksums)):
+            checksum = None if (checksums[layer] is None) else checksumToString(checksums[layer])
+            state.shuffle.storeChecksum(checksum, index=layer)
+        return checksums
+
+    def _opening_failed(f):
+        log.error('Opening the checksums failed: ' + str(f.getErrorMessage()))
+        return f
+
+    sums = computeHashShareSums(escrows, state)
+    state.shuffle.storeHashShareSums(sums)
+    if (not state.opensChecksumsEarly()):
+        return escrows
+
+    summands = []
+    for checksum_share in sums:
+        summand = WrapperSmpcValue(state)
+        summand.initialize(checksum_share)
+        summands.append(summand)
+    checksums = state.smpc.newValue('vrec', state, 'C', 0)
+    checksums.initialize(summands, order=hash_order)
+    checksums_deferred = checksums.getPublicValue()
+    checksums_deferred.addCallbacks(_store_checksums, _opening_failed)
+    state.shuffle.setChecksumsDeferred(checksums_deferred)
+    return escrows
+
 
 def shuffling_phase(_, state):
     """ Implementation of the shuffling phase. """
@@ -39,13 +96,16 @@ def shuffling_phase(_, state):
         state.shuffle.receivedAddrBroadcast(addresses, sender_rank)
         return v
 
-    def checksumToString(checksum):
-        return '{0:0{1}x}'.format(int(checksum) % hash_modulus, 64)
-
     def recombineChecksum(escrows, layer):
-        checksum_share = 0
-        for escrow in escrows:
-            checksum_share = (checksum_share + escrow['hash_share'][layer]) % hash_order
+        opened_checksum = state.shuffle.getOpenedChecksum(layer)
+        if (opened_checksum is not None):
+            return opened_checksum  # All checksums are opened at once
+
+        checksum_share = state.shuffle.getHashShareSum(layer)
+        if (checksum_share is None):
+            checksum_share = 0
+            for escrow in escrows:
+                checksum_share = (checksum_share + escrow['hash_share'][layer]) % hash_order
         checksum_share_wrapped = WrapperSmpcValue(state)
         checksum_share_wrapped.initialize(checksum_share)
         checksum = state.smpc.newValue('rec', state, 'c', layer)
@@ -55,11 +115,19 @@ def shuffling_phase(_, state):
         checksum_deferred.addCallback(state.shuffle.storeChecksum, index=layer)
         return checksum_deferred
 
-    def computeReferenceChecksum(layered_encryption):
+    def sumEntryHashes(entries):
         output_checksum = 0
-        for entry in layered_encryption:
+        for entry in entries:
             hash_str = hashlib.sha256(entry).hexdigest()
             output_checksum = (output_checksum + int(hash_str, 16)) % hash_order
+        return output_checksum
+
+    def computeReferenceChecksum(layered_encryption, sender_rank):
+        """ The reference checksum is usually folded while the chunks of the
+            broadcast arrive. Otherwise, it is computed from all entries. """
+        output_checksum = state.shuffle.getReferenceChecksum(sender_rank, len(layered_encryption))
+        if (output_checksum is None):
+            output_checksum = sumEntryHashes(layered_encryption)
         output_checksum = checksumToString(output_checksum)
         return output_checksum
 
@@ -89,43 +157,73 @@ def shuffling_phase(_, state):
         prng.shuffle(output_addresses)
         return output_addresses
 
-    def decryptionMixnet(addresses):
+    def decryptionMixnet(addresses, decrypted_chunks=None):
         """ Decryption mixnet operation. Consists of removing an encryption
             layer from each output address in the output address array, and
-            then permutating the addresses. """
+            then permutating the addresses. Decryption is done in parallel,
+            hence return a Deferred firing with the permutated addresses.
+            If the addresses have been received in chunks, their decryption
+            has been started already; decrypted_chunks holds its Deferreds. """
         log.debug('Entered output address processing.')
 
         def decryptAddressLayer(addresses):
-            crypter = state.crypto.getCrypter()
-            result = []
-            for address in addresses:
-                plain = crypter.decrypt(address, ciphername='aes-256-cbc')
-                result.append(plain)
-            return result
+            if (decrypted_chunks is None or len(decrypted_chunks) == 0 or None in decrypted_chunks):
+                decrypted = decryptAddresses(addresses, state.crypto)
+                decrypted.addCallback(AddressArray)
+                return decrypted
+            decrypted = DeferredList(decrypted_chunks, fireOnOneErrback=True, consumeErrors=True)
+            decrypted.addCallback(lambda chunks: AddressArray.concatenate([chunk for (_, chunk) in chunks]))
+            return decrypted
 
         def shuffleAddresses(addresses):
-            """ Create a shuffled copy (only references!) of the encrypted output addresses. """
-            indices = [i for i in xrange(0, len(addresses))]
+            """ Create a shuffled copy of the packed output addresses. Only
+                the array of indices is shuffled, which is then applied. """
+            indices = array('L', xrange(0, len(addresses)))
             random.shuffle(indices)
-            result = []
-            for index in indices:
-                result.append(addresses[index])
-            return result
+            return addresses.take(indices)
 
         decrypted_addresses = decryptAddressLayer(addresses)
-        shuffled_addresses = shuffleAddresses(decrypted_addresses)
-        return shuffled_addresses
+        decrypted_addresses.addCallback(shuffleAddresses)
+        return decrypted_addresses
 
     def broadcastShufflingResult(addresses):
+        """ Broadcast the addresses in chunks, so that our successor can
+            start decrypting them while the remaining ones are transmitted. """
         crypter = state.crypto.getCrypter()
-        seq = state.transactions.getNextSequenceNumber()
-        msg = req.addr.encode(state.mixnet.getRank(), seq, crypter, addresses)
         peers = state.mixnet.getConnectedMixpeers()
-        # Create deferred for broadcast, fired after the last response is received
-        broadcast_deferred = state.transactions.addTransaction(
-            BroadcastTransaction(state.mixnet.getRank(), peers, msg, seq, None)
-        )
-        return broadcast_deferred
+        chunks = [addresses[i:(i + ADDR_CHUNK_SIZE)] for i in xrange(0, len(addresses), ADDR_CHUNK_SIZE)] or [[]]
+        broadcast_deferreds = []
+        for i in xrange(0, len(chunks)):
+            seq = state.transactions.getNextSequenceNumber()
+            msg = req.adr2.encode(state.mixnet.getRank(), seq, crypter, chunks[i], i, len(chunks))
+            # Create deferred for broadcast, fired after the last response is received
+            broadcast_deferreds.append(state.transactions.addTransaction(
+                BroadcastTransaction(state.mixnet.getRank(), peers, msg, seq, None)
+            ))
+        return DeferredList(broadcast_deferreds, fireOnOneErrback=True, consumeErrors=True)
+
+    """ Decryption of chunks received from our predecessor """
+    decrypted_chunks = []
+
+    def receivedAddrChunk(addresses, sender_rank, chunk, chunks):
+        state.shuffle.foldReferenceChecksum(sender_rank, sumEntryHashes(addresses), len(addresses))
+        if (sender_rank != state.mixnet.getRank() - 1):
+            return
+        if (len(decrypted_chunks) != chunks):
+            decrypted_chunks[:] = [None] * chunks
+        decrypted_chunks[chunk] = decryptAddresses(addresses, state.crypto)
+        return
+
+    def decryptAndBroadcast(addresses, decrypted_chunks=None):
+        """ Perform our decryption mixnet step and broadcast its result. """
+        def _broadcast(shuffled_addresses):
+            deferred = broadcastShufflingResult(shuffled_addresses)
+            deferred.addCallback(_fire_shuffle_broadcast, shuffled_addresses, state.mixnet.getRank())
+            return deferred
+
+        deferred = decryptionMixnet(addresses, decrypted_chunks)
+        deferred.addCallback(_broadcast)
+        return deferred
 
     def receivedAddrBroadcast(params):
         (addresses, sender_rank) = params
@@ -141,17 +239,14 @@ def shuffling_phase(_, state):
 
         def checksumRoutine(_):
             deferred = recombineChecksum(state.input.getAssignedEscrows(), sender_rank)
-            reference_checksum = computeReferenceChecksum(addresses)
+            reference_checksum = computeReferenceChecksum(addresses, sender_rank)
             deferred.addBoth(compareChecksums, reference_checksum=reference_checksum)
             return deferred
 
         def decideAction(checksum):
 
             if (sender_rank == state.mixnet.getRank() - 1):  # It's my turn
-                shuffled_addresses = decryptionMixnet(addresses)
-                deferred = broadcastShufflingResult(shuffled_addresses)
-                deferred.addCallback(_fire_shuffle_broadcast, shuffled_addresses, state.mixnet.getRank())
-                return deferred
+                return decryptAndBroadcast(addresses, decrypted_chunks)
 
             if (state.mixnet.isLastMixpeer(sender_rank)):  # I have received the plaintext addresses => finalize!
                 ordered_addresses = orderLexicographically(addresses)
@@ -172,6 +267,7 @@ def shuffling_phase(_, state):
     """ The actual implementation starts here. """
 
     state.shuffle.addAddrDeferredCallback(receivedAddrBroadcast)
+    state.shuffle.addAddrChunkCallback(receivedAddrChunk)
     shuffling_deferred = state.shuffle.getShufflingDeferred()
 
     state.shuffle.initialized()
@@ -179,8 +275,6 @@ def shuffling_phase(_, state):
     """ "If I am the first peer, start mixing based on input user submissions. """
     if (state.mixnet.getRank() == 0):
         addresses = state.input.getEncryptedOutputAddresses()
-        addresses_decrypted = decryptionMixnet(addresses)
-        deferred = broadcastShufflingResult(addresses_decrypted)
-        deferred.addCallback(_fire_shuffle_broadcast, addresses_decrypted, state.mixnet.getRank())
+        decryptAndBroadcast(addresses)
 
     return shuffling_deferred
@@ -21,16 +21,18 @@
 
 from binascii import hexlify
 
-from low.CoinPartyProxy import bitcoind
-from low.TransactionStrategies import splitMixingAmount, defineStreamingSchedule
+from low.CoinPartyProxy import bitcoind, chain_scanner
+from low.OutboundTracker import OutboundTracker
+from low.TransactionStrategies import planPayouts
 from low.smpc.WrapperSmpcValue import WrapperSmpcValue
-from low.smpc.AdditionSmpcValue import AdditionSmpcValue
-from low.smpc.ConstantMultiplicationSmpcValue import ConstantMultiplicationSmpcValue
+from low.smpc.VectorRecombinationSmpcValue import VectorRecombinationSmpcValue
+from low.constants import bitcoin_order
 
-from twisted.internet import reactor
 from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.threads import deferToThread
 
 from hashlib import sha256
+from decimal import Decimal
 import bitcoin as bc
 from bitcoin.core.key import CPubKey
 from bitcoin.wallet import CBitcoinAddress
@@ -43,152 +45,259 @@ from Crypto.Random.random import StrongRandom
 from low.log import Logger
 log = Logger('transaction_phase')
 
-# ToDo: Temporary construct!
-transaction_ctr = 0
+""" nSequence of inputs that signal opt-in replace-by-fee (BIP 125). """
+RBF_SEQUENCE = 0xfffffffd
+
+outbound_tracker = OutboundTracker(bitcoind, chain_scanner)
 
 
 def broadcastTransaction(tx):
     return bitcoind.sendrawtransaction(tx)
 
 
-def createTransaction(txid, vout, value, output_address, escrow_index, state):
-    """ Create an transaction from an escrow address, defined by a previous txid, to the output address """
-
-    # This will be the return value, a little indirection to not return a Share.
-    tx_deferred = Deferred()
-
-    def _fire_response(tx):
-        tx_deferred.callback(tx)
-        return
-
-    def _signatureCallback(signature, shares, hash, transaction):
-        return signature
-
-    def _computeSignatureShare(hash):
-
-        def _get_R(R_deferred):
-            R = R_deferred.x()
-            return R
-
-        def _compute_summand2(R, k_inv_d_share):
-            summand2 = ConstantMultiplicationSmpcValue(state)
-            summand2_deferred = summand2.initialize(R, k_inv_d_share)
-            return summand2_deferred
-
-        def _final_sum(deferreds):
-            global transaction_ctr
-            summand1 = WrapperSmpcValue(state)
-            summand2 = WrapperSmpcValue(state)
-            summand1.initialize(deferreds[0][1])
-            summand2.initialize(deferreds[1][1])
-            s = AdditionSmpcValue(state)  # add secret values of summand1, summand2 (see below)
-            s_deferred = s.initialize(summand1, summand2)
-            return s_deferred
+def _computeSignatureShare(hash, escrow_index, nonce, state):
+    """ Compute this peer's share of the signature S for the given hash.
+        Everything that does not depend on the hash has been precomputed
+        along with the escrow. Return the share of S as well as r. """
+    context = state.signing.getContext(escrow_index, nonce)
+    e = int(hexlify(hash), 16)
+
+    """ Calculation to be performed: S_share = e * k_inv_share + r * k_inv_d_share """
+    S_share = (e * context['ki'] + context['rkid']) % bitcoin_order
+    return (S_share, context['r'])
+
+
+def _signatureToDER(S, R):
+    """ Encode a signature (r, S). Both S and n - S are valid, but only the
+        low one is standard (BIP 62), i.e., relayed by bitcoind. """
+    S = int(S)
+    if (S > bitcoin_order // 2):
+        S = bitcoin_order - S
+    S_der = der.encode_integer(S)
+    R_der = der.encode_integer(int(R))
+
+    signature_der = der.encode_sequence(R_der, S_der) + chr(0x01)
+    return signature_der
+
+
+def getTransactionID(tx):
+    """ Return the txid of a serialized transaction. """
+    return bc.core.b2lx(bc.core.Hash(bc.core.x(tx)))
+
+
+def _escrowScriptTemplate(escrow_index, state):
+    """ Return the public key of an escrow and its P2PKH output script. """
+    def _create():
+        cpub = CPubKey(state.input.getInputPeer('id', escrow_index)['pubkey'])
+        script_pubkey = bc.core.script.CScript([
+            bc.core.script.OP_DUP,
+            bc.core.script.OP_HASH160,
+            bc.core.Hash160(cpub),
+            bc.core.script.OP_EQUALVERIFY,
+            bc.core.script.OP_CHECKSIG
+        ])
+        return (cpub, script_pubkey)
+    return state.signing.getScript(('escrow', escrow_index), _create)
+
+
+def escrowScriptPubKey(escrow_index, state):
+    """ Return the P2PKH output script of an escrow address. """
+    return _escrowScriptTemplate(escrow_index, state)[1]
+
+
+def addressScriptPubKey(address, state=None):
+    if (state is None):
+        return CBitcoinAddress(address).to_scriptPubKey()
+    return state.signing.getScript(('address', address), lambda: CBitcoinAddress(address).to_scriptPubKey())
+
+
+def prepareTransaction(inputs, outputs, state):
+    """ Create an unsigned transaction spending escrow outputs and compute
+        the shares of the signatures of all its inputs.
+        inputs is a list of dictionaries (txid, vout, escrow_index, nonce),
+        where each input is signed using the given nonce of its escrow.
+        Optionally, an input's nSequence is given as 'sequence'.
+        outputs is a list of (scriptPubKey, value) pairs.
+        Return a dictionary holding the transaction, the signature shares
+        and the corresponding values r. """
+    txins = []
+    script_pubkeys = []
+    pubkeys = []
+    for i in inputs:
+        txins.append(bc.core.CMutableTxIn(
+            bc.core.COutPoint(bc.core.lx(i['txid']), i['vout']),
+            nSequence=i.get('sequence', 0xffffffff)
+        ))
+        (cpub, script_pubkey) = _escrowScriptTemplate(i['escrow_index'], state)
+        script_pubkeys.append(script_pubkey)
+        pubkeys.append(cpub)
+    txouts = [bc.core.CMutableTxOut(int(value * bc.core.COIN), output_script) for (output_script, value) in outputs]
 
-        # Set parameters for creating the share of the signature
-        e = int(hexlify(hash), 16)
-        kG_deferred = state.smpc.getValue('k', escrow_index).getPublicValue()
-        R = state.smpc.getValue('k', escrow_index).getPublicValue()
-        k_inv_share = state.smpc.getValue('ki', escrow_index)
-        k_inv_d_share = state.smpc.getValue('kid', escrow_index)
+    # Create unsigned transaction
+    tx = bc.core.CMutableTransaction(txins, txouts)
+
+    # Create signature hashes; each input is signed on its own
+    S_shares = []
+    rs = []
+    for n in xrange(0, len(inputs)):
+        sighash = bc.core.script.SignatureHash(script_pubkeys[n], tx, n, bc.core.script.SIGHASH_ALL)
+        (S_share, r) = _computeSignatureShare(sighash, inputs[n]['escrow_index'], inputs[n]['nonce'], state)
+        S_shares.append(S_share)
+        rs.append(r)
+    return {
+        'tx'             : tx,
+        'script_pubkeys' : script_pubkeys,
+        'pubkeys'        : pubkeys,
+        'S_shares'       : S_shares,
+        'r'              : rs
+    }
+
+
+def finalizeTransaction(S_list, prepared):
+    """ Insert the signatures (r, S) into a prepared transaction, one per
+        input. Return the serialized transaction.
+        Verifying the scripts and serializing is done in pure Python and
+        does not touch any shared state. Hence, this is usually run in the
+        reactor's thread pool (see finalizeTransactionInThread). """
+    tx = prepared['tx']
+    for n in xrange(0, len(tx.vin)):
+        txin = tx.vin[n]
+        txin.scriptSig = bc.core.script.CScript([_signatureToDER(S_list[n], prepared['r'][n]), prepared['pubkeys'][n]])
 
-        """ Calculation to be performed: S_share = e * k_inv_share + R * k_inv_d_share """
-        try:
-            summand1 = ConstantMultiplicationSmpcValue(state)
-            summand1_deferred = summand1.initialize(e, k_inv_share)
-            kG_deferred.addCallback(_get_R)
-            kG_deferred.addCallback(_compute_summand2, k_inv_d_share=k_inv_d_share)
-            R.addCallback(_get_R)
-            S_share = DeferredList([summand1_deferred, kG_deferred])
-            S_share.addCallback(_final_sum)
-            return (S_share, R)
-        except BaseException as ex:
-            log.critical('Error in signature generation! Error: ' + str(ex))
-            raise RuntimeError('signing_share_failed')
-
-    def _signatureToDER(S, R):
-        S_der = der.encode_integer(int(S))
-        R_der = der.encode_integer(int(R))
-
-        signature_der = der.encode_sequence(R_der, S_der) + chr(0x01)
-        return signature_der
-
-    def _reconstruct_signature(S_share):
         try:
-            global transaction_ctr
-            final_sum = WrapperSmpcValue(state)
-            final_sum.initialize(S_share)
-            S = state.smpc.newValue('rec', state, 'S', transaction_ctr)
-            return S.initialize(final_sum)
+            VerifyScript(txin.scriptSig, prepared['script_pubkeys'][n], tx, n, (bc.core.scripteval.SCRIPT_VERIFY_P2SH, bc.core.scripteval.SCRIPT_VERIFY_LOW_S))
         except BaseException as e:
-            log.critical('S reconstruction failed! ' + str(e))
-            raise RuntimeError('signing_reconstruct_failed')
+            log.error(str(e))
+            raise RuntimeError('signing_failed')
 
-    def _computeSignature(S_share_R):
-        S_share = S_share_R[0][1]
-        R = S_share_R[1][1]
+    transaction_serialized = bc.core.b2x(tx.serialize())
+    return transaction_serialized
 
-        def _extract_signature(_):
-            global transaction_ctr
-            signature = state.smpc.getValue('S', transaction_ctr).getPublicValue()
-            transaction_ctr += 1
-            return signature
 
-        signature = _reconstruct_signature(S_share)
-        signature.addCallback(_extract_signature)
-        signature.addCallback(_signatureToDER, R=R)
-        return signature
+def finalizeTransactionInThread(S_list, prepared):
+    return deferToThread(finalizeTransaction, S_list, prepared)
 
-    def _computeTransaction(signature, tx, script_pubkey, pubkey):
-        txin = tx.vin[0]
-        txin.scriptSig = bc.core.script.CScript([signature, pubkey])
 
-        try:
-            VerifyScript(txin.scriptSig, script_pubkey, tx, 0, (bc.core.scripteval.SCRIPT_VERIFY_P2SH,))
-        except BaseException as e:
-            log.error(str(e))
-            raise RuntimeError('signing_failed')
+def createTransaction(txid, vout, value, output_address, escrow_index, state, nonce=0, change_value=None):
+    """ Create an transaction from an escrow address, defined by a previous txid, to the output address.
+        If change_value is given, the change is sent back to the escrow address. """
 
-        transaction_serialized = bc.core.b2x(tx.serialize())
-        return transaction_serialized
-
-    cpub = CPubKey(state.input.getInputPeer('id', escrow_index)['pubkey'])
-    txid = bc.core.lx(txid)
-
-    # TXIN information
-    txin = bc.core.CMutableTxIn(bc.core.COutPoint(txid, vout))
-    txin_scriptPubKey = bc.core.script.CScript([
-        bc.core.script.OP_DUP,
-        bc.core.script.OP_HASH160,
-        bc.core.Hash160(cpub),
-        bc.core.script.OP_EQUALVERIFY,
-        bc.core.script.OP_CHECKSIG
-    ])
-
-    # TXOUT information
-    txout = bc.core.CMutableTxOut(
-        int(value * bc.core.COIN),
-        CBitcoinAddress(output_address).to_scriptPubKey()
-    )
+    # Signatures may be computed concurrently. Hence, the session must be
+    # opened right away, i.e., in the (same) order of invocation on each peer.
+    session = state.signing.openSession(escrow_index)
 
-    # Create unsigned transaction
-    tx = bc.core.CMutableTransaction([txin], [txout])
-
-    # Create signature hash
-    sighash = bc.core.script.SignatureHash(txin_scriptPubKey, tx, 0, bc.core.script.SIGHASH_ALL)
-    (S_share, R) = _computeSignatureShare(sighash)
-    deferreds = DeferredList([S_share, R])
-    deferreds.addCallback(_computeSignature)
-    deferreds.addCallback(_computeTransaction,
-        tx=tx,
-        script_pubkey=txin_scriptPubKey,
-        pubkey=cpub
-    )
-    deferreds.addCallback(_fire_response)
+    def _close_session(v):
+        state.signing.closeSession(session)
+        return v
 
+    outputs = [(addressScriptPubKey(output_address, state), value)]
+    if (change_value is not None):
+        outputs.append((escrowScriptPubKey(escrow_index, state), change_value))
+    prepared = prepareTransaction(
+        [{'txid' : txid, 'vout' : vout, 'escrow_index' : escrow_index, 'nonce' : nonce}],
+        outputs,
+        state
+    )
+    try:
+        final_sum = WrapperSmpcValue(state)
+        final_sum.initialize(prepared['S_shares'][0])
+        S = state.smpc.newValue('rec', state, session[0], session[1])
+        S.initialize(final_sum)
+    except BaseException as e:
+        log.critical('S reconstruction failed! ' + str(e))
+        raise RuntimeError('signing_reconstruct_failed')
+    tx_deferred = S.getPublicValue()
+    tx_deferred.addCallback(lambda S: [S])
+    tx_deferred.addCallback(finalizeTransactionInThread, prepared=prepared)
+    tx_deferred.addBoth(_close_session)
     return tx_deferred
 
 
+def createTransactions(transactions, state, session=None):
+    """ Create several transactions at once. transactions is a list of
+        (inputs, outputs) pairs as expected by prepareTransaction. The shares
+        of all signatures are opened together in as few vector recombinations
+        as possible. Return a list of Deferreds (one per transaction) that
+        fire with the serialized transactions.
+        If session is given, the signatures are opened within that SMPC
+        session instead of newly opened ones; they must fit into one vector. """
+
+    def _signatures_opened(S_list, prepared_batch):
+        """ Split the opened signatures into those of each transaction. """
+        signatures = []
+        offset = 0
+        for p in prepared_batch:
+            signatures.append(S_list[offset:(offset + len(p['S_shares']))])
+            offset += len(p['S_shares'])
+        return signatures
+
+    def _open_signatures(prepared_batch, session):
+        summands = []
+        for p in prepared_batch:
+            for S_share in p['S_shares']:
+                summand = WrapperSmpcValue(state)
+                summand.initialize(S_share)
+                summands.append(summand)
+        S = state.smpc.newValue('vrec', state, session[0], session[1])
+        S.initialize(summands)
+        S_list = S.getPublicValue()
+        S_list.addCallback(_signatures_opened, prepared_batch=prepared_batch)
+        return S_list
+
+    def _finalize_transactions(signatures, prepared_batch, deferreds):
+        """ Finalize each transaction in the thread pool and fire its
+            Deferred as soon as it is done. """
+        for (d, S_list, p) in zip(deferreds, signatures, prepared_batch):
+            finalizeTransactionInThread(S_list, p).chainDeferred(d)
+        return None
+
+    def _fail_transactions(f, deferreds):
+        for d in deferreds:
+            if (not d.called):
+                d.errback(f)
+        return None
+
+    def _close_session(v, session):
+        state.signing.closeSession(session)
+        return v
+
+    if (session is not None and sum([len(inputs) for (inputs, _) in transactions]) > VectorRecombinationSmpcValue.getMaximumLength()):
+        raise ValueError('vector_too_long')
+
+    prepared = [prepareTransaction(inputs, outputs, state) for (inputs, outputs) in transactions]
+
+    # Split into batches such that the signature shares fit into one vector
+    batches = [[]]
+    batch_length = 0
+    for p in prepared:
+        if (batch_length + len(p['S_shares']) > VectorRecombinationSmpcValue.getMaximumLength() and len(batches[-1]) > 0):
+            batches.append([])
+            batch_length = 0
+        batches[-1].append(p)
+        batch_length += len(p['S_shares'])
+
+    result = []
+    for prepared_batch in batches:
+        if (len(prepared_batch) == 0):
+            continue
+        deferreds = [Deferred() for _ in prepared_batch]
+        result += deferreds
+
+        if (session is not None):
+            batch = _open_signatures(prepared_batch, session)
+        else:
+            # Same as in createTransaction, the session must be opened right away
+            batch_session = state.signing.openSession(len(prepared_batch))
+            batch = _open_signatures(prepared_batch, batch_session)
+            batch.addBoth(_close_session, session=batch_session)
+        batch.addCallbacks(
+            _finalize_transactions, _fail_transactions,
+            callbackKeywords={'prepared_batch' : prepared_batch, 'deferreds' : deferreds},
+            errbackKeywords={'deferreds' : deferreds}
+        )
+    return result
+
+
 def transaction_phase(_, state):
 
     log.debug('Trying to create transactions from escrows to outputs.')
@@ -200,73 +309,236 @@ def transaction_phase(_, state):
         state.concludeMixing()
 
     def obtain_splittings_and_schedules(input_peers, split_amount, mixing_window_mins, seed):
+        """ Return all payouts as (input peer, part) in order of their release. """
         prng_gen = SeedablePrngGenerator()
         prng_gen.reseed(seed)
         prng = StrongRandom(randfunc=prng_gen.pseudo_random_data)
-        for input_peer in input_peers:
-            input_peer['split'] = splitMixingAmount(split_amount, prng)
-            input_peer['schedule'] = defineStreamingSchedule(len(input_peer['split']), mixing_window_mins, prng)
-        return
+        (splits, schedules, payouts) = planPayouts(len(input_peers), split_amount, mixing_window_mins, prng, state.signing.getNoncesPerEscrow())
+        for i in xrange(0, len(input_peers)):
+            input_peers[i]['split'] = [Decimal(str(v)) for v in splits[i]]
+            input_peers[i]['schedule'] = schedules[i]
+        return [(input_peers[peer], part) for (_, peer, part) in payouts]
+
+    def plan_transactions(scheduled, batch_interval):
+        """ Assign the scheduled payouts to transactions. If batching is
+            enabled, all payouts within the same time bucket are aggregated
+            into one transaction, which is released together with its last
+            payout. Otherwise, each payout has its own transaction.
+            Each escrow contributes one input (and one fee) per transaction,
+            which is signed using its next nonce. All but the last
+            transaction of an escrow send the change back to the escrow
+            address, where it is spent by its next transaction. The last
+            one does not have change, i.e., its fee absorbs what is left.
+            If fee bumping is enabled, the inputs signal replace-by-fee and
+            what is left is kept in a reserve output back to the escrow
+            address instead, unless it is less than a fee. This is the budget
+            for bumping the fee of transactions that no other transaction
+            depends on, one fee per spare nonce. Payouts keep their values,
+            i.e., the reserve is never paid out to the output addresses. """
+        fee = state.getTransactionFee()
+        fee_bumping = (state.getFeeBumpBlocks() > 0)
+        plans = []
+        buckets = dict()
+        for (escrow, index) in scheduled:
+            release_time = escrow['schedule'][index]
+            bucket = int(release_time // batch_interval) if (batch_interval > 0) else None
+            plan = buckets.get(bucket)
+            if (plan is None):
+                plan = {'number' : len(plans), 'payouts' : [], 'release_time' : release_time, 'txid' : None}
+                plans.append(plan)
+                if (bucket is not None):
+                    buckets[bucket] = plan
+            plan['payouts'].append((escrow, index))
+            plan['release_time'] = max(plan['release_time'], release_time)
 
-    def serialize_schedules(escrows):
-        serialization = []
         for escrow in escrows:
-            for i in xrange(0, len(escrow['schedule'])):
-                serialization.append((escrows.index(escrow), escrow['schedule'][i]))
-        log.debug('Serialization before sorting:\n' + str(serialization))
-        serialization.sort(key=lambda x: x[1])
-        log.debug('Serialization after sorting:\n' + str(serialization))
-        log.debug('Serialization returned:\n' + str([x[0] for x in serialization]))
-        return [x[0] for x in serialization]
-
-    def create_transaction(logical_time, escrow, index):
-
-        def _debug_print(tx, escrow, value):
-            log.info('    ' + escrow['address'] + ' --> ' + escrow['output'] + ' (' + str(value) + ')')
+            escrow['funds'] = (None, escrow['txid'], escrow['tx_vout'])  # (plan, txid, vout)
+            escrow['available'] = state.getCommitmentValue()
+            escrow['nonce'] = 0
+            escrow['remaining'] = len(escrow['split'])
+
+        for plan in plans:
+            plan['inputs'] = []
+            plan['outputs'] = []
+            plan['depends'] = []
+            plan['reserves'] = []  # (escrow, index of its reserve output)
+            participants = []
+            for (escrow, index) in plan['payouts']:
+                if (escrow not in participants):
+                    participants.append(escrow)
+            for escrow in participants:
+                (funding_plan, txid, vout) = escrow['funds']
+                if (funding_plan is not None and funding_plan not in plan['depends']):
+                    plan['depends'].append(funding_plan)
+                plan['inputs'].append({
+                    'plan'         : funding_plan,
+                    'txid'         : txid,
+                    'vout'         : vout,
+                    'escrow_index' : escrow['id'],
+                    'nonce'        : escrow['nonce'],
+                    'sequence'     : RBF_SEQUENCE if fee_bumping else 0xffffffff
+                })
+                escrow['nonce'] += 1
+                escrow['available'] -= fee
+                for index in [i for (e, i) in plan['payouts'] if e is escrow]:
+                    plan['outputs'].append((addressScriptPubKey(escrow['output'], state), escrow['split'][index]))
+                    escrow['available'] -= escrow['split'][index]
+                    escrow['remaining'] -= 1
+                if (escrow['remaining'] > 0):
+                    escrow['funds'] = (plan, None, len(plan['outputs']))
+                    plan['outputs'].append((escrowScriptPubKey(escrow['id'], state), escrow['available']))
+                elif (fee_bumping and escrow['available'] >= fee):
+                    plan['reserves'].append((escrow, len(plan['outputs'])))
+                    plan['outputs'].append((escrowScriptPubKey(escrow['id'], state), escrow['available']))
+            plan['depth'] = max([p['depth'] + 1 for p in plan['depends']] + [0])
+        for plan in plans:
+            plan['leaf'] = (len([p for p in plans if plan in p['depends']]) == 0)
+        return plans
+
+    def bump_outputs(plan, bumps):
+        """ Return the outputs of the given bump of a transaction, which
+            pays one more fee per input than the previous version. It is
+            taken from the reserve outputs; a reserve that cannot fund
+            another bump goes into the fee as a whole. Return None if the
+            reserves are used up. """
+        fee = state.getTransactionFee()
+        dropped = []
+        outputs = list(plan['outputs'])
+        for (_, n) in plan['reserves']:
+            (script_pubkey, value) = outputs[n]
+            left = value - fee * bumps  # Reserve of the previous version
+            if (left < fee):
+                return None
+            if (left - fee < fee):
+                dropped.append(n)
+            outputs[n] = (script_pubkey, left - fee)
+        return [outputs[n] for n in xrange(0, len(outputs)) if n not in dropped]
+
+    def bump_transaction(tip_height, bumps, plan):
+        """ Replace an unconfirmed transaction by one paying one more fee per
+            input, which is taken from the escrows' reserve outputs (see
+            bump_outputs). As signing the same hash with a nonce twice would
+            leak the escrow's key, each input is signed with one of its
+            escrow's spare nonces, which follow the nonce of the escrow's
+            last planned transaction. Only transactions that no other
+            transaction depends on are bumped, since the txid changes.
+            All mixing peers need to bump together. Thus, bumps are due
+            depending on the block height, relative to the agreed height of
+            the streaming phase's start. Each bump is opened within its own
+            SMPC session ('B', derived from the plan and bump number), and
+            its inputs and outputs only depend on the plan and bump number,
+            too, i.e., they are the same on all mixing peers. """
+        if (tip_height is None or tip_height < start_height + state.getFeeBumpBlocks() * (bumps + 1)):
+            return None
+        nonces = state.signing.getNoncesPerEscrow()
+        if (len(plan['reserves']) != len(plan['inputs'])):
+            return None
+        if (max([i['nonce'] for i in plan['inputs']]) + bumps + 1 >= nonces):
+            return None  # Out of nonces
+        outputs = bump_outputs(plan, bumps)
+        if (outputs is None):
+            return None  # Out of reserves
+        inputs = [dict(i, nonce=(i['nonce'] + bumps + 1)) for i in plan['inputs']]
+        log.info('Bumping the fee of transaction ' + str(plan['number']) + ' (bump #' + str(bumps + 1) + ').')
+        return createTransactions([(inputs, outputs)], state, session=('B', plan['number'] * nonces + bumps))[0]
+
+    def release_transaction(tx, plan):
+        """ Track a transaction until it is confirmed and broadcast it. A
+            failed broadcast is retried by the outbound tracker. The
+            streaming phase does not wait for its confirmation; if its fee
+            may be bumped, the confirmation is collected in bumpable. """
+        bump = None
+        if (plan['leaf'] and len(plan['reserves']) > 0):
+            bump = lambda tip_height, bumps: bump_transaction(tip_height, bumps, plan)
+        confirmed = outbound_tracker.release(tx, bump)
+        if (bump is not None):
+            bumpable.append(confirmed)
+        return tx
+
+    def schedule_transaction(tx_deferred, plan, start_time):
+        """ Broadcast a transaction that is being signed once it is due.
+            Signing is done ahead of time (and for many outputs at once), so
+            that SMPC latency does not delay the schedule. The broadcast is
+            queued at its absolute release time with the payout scheduler. """
+
+        def _debug_print(tx, plan):
+            for (escrow, index) in plan['payouts']:
+                log.info('    ' + escrow['address'] + ' --> ' + escrow['output'] + ' (' + str(escrow['split'][index]) + ')')
             return tx
 
         def _debug_fail(f):
             log.critical('OUTPUT TRANSACTION FAILED! ' + str(f.getErrorMessage()))
             return f
 
-        def _return_next_logical_time(_, logical_time):
-            return logical_time
+        def _schedule_broadcast(tx, release_time):
+            if (release_time < state.getClock().seconds()):
+                log.warning('Transaction was signed after its release time.')
+            return state.payouts.schedule(release_time, release_transaction, tx, plan)
 
-        try:
-            timediff = escrow['schedule'][index] - logical_time
-        except BaseException as e:
-            log.error(str(e))
-            return
-        d = Deferred()
-        d.addCallback(
-            createTransaction,
-            vout=escrow['tx_vout'],
-            value=state.getBitcoinValue(),
-            output_address=escrow['output'],
-            escrow_index=escrow['id'],
-            state=state
-        )
-        d.addCallback(_debug_print, escrow=escrow, value=escrow['split'][index])
-        d.addErrback(_debug_fail)
-        d.addBoth(_return_next_logical_time, logical_time=escrow['schedule'][index])
-        reactor.callLater(timediff, d.callback, escrow['txid'])
-        return d
+        tx_deferred.addCallback(_schedule_broadcast, release_time=(start_time + plan['release_time']))
+        tx_deferred.addCallback(_debug_print, plan=plan)
+        tx_deferred.addErrback(_debug_fail)
+        return tx_deferred
 
     log.info('Performing final transactions:')
 
     # Obtain splittings
     mixing_window = state._mixing_window_mins
-    obtain_splittings_and_schedules(escrows, state.getBitcoinValue(), mixing_window, sha256(state.shuffle.getChecksum()).digest())
-    transactions = serialize_schedules(escrows)
-
+    scheduled = obtain_splittings_and_schedules(escrows, state.getBitcoinValue(), mixing_window, sha256(state.shuffle.getChecksum()).digest())
+
+    def store_txid(tx, plan):
+        plan['txid'] = getTransactionID(tx)
+        return tx
+
+    def sign_depth(_, depth, broadcasts):
+        """ Sign all transactions of the given depth. As transactions spend
+            the change of those they depend on, the depths are signed one
+            after another. Skip transactions whose dependencies failed. """
+        jobs = [plan for plan in plans if plan['depth'] == depth and None not in [p['txid'] for p in plan['depends']]]
+        for plan in jobs:
+            for i in plan['inputs']:
+                if (i['plan'] is not None):
+                    i['txid'] = i['plan']['txid']
+        tx_deferreds = createTransactions([(plan['inputs'], plan['outputs']) for plan in jobs], state)
+        for i in xrange(0, len(jobs)):
+            tx_deferreds[i].addCallback(store_txid, plan=jobs[i])
+        # Failures are passed on to the payouts' chains (see wait_for_broadcasts)
+        signed = DeferredList(tx_deferreds)
+        for i in xrange(0, len(jobs)):
+            broadcasts.append(schedule_transaction(tx_deferreds[i], jobs[i], start_time))
+        return signed
+
+    def wait_for_broadcasts(_, broadcasts):
+        # Failed payouts have been logged already
+        return DeferredList(broadcasts, consumeErrors=True)
+
+    def keep_bumping(v):
+        """ Bumps are signed by the mixing peers together, hence the state
+            has to receive the messages of this round until all bumpable
+            transactions are confirmed, even after the round concluded. """
+        state.setOutboundDeferred(DeferredList(bumpable))
+        return v
+
+    def report_slip(v):
+        (dispatched, mean, maximum) = state.payouts.getSlipStatistics()
+        log.info('Released ' + str(dispatched) + ' transactions with a mean slip of ' + str(mean) + ' seconds (max: ' + str(maximum) + ' seconds).')
+        return v
+
+    # The order of signing must be the same on all mixing peers, i.e., the serialized schedule
+    start_time = state.getClock().seconds()
+    # Fee bumps are due relative to the height at which all commitments were
+    # confirmed. Unlike the tip height, it is the same on all mixing peers.
+    start_height = max([escrow['tx_height'] for escrow in escrows] + [0])
+    plans = plan_transactions(scheduled, state.getBatchInterval())
+
+    broadcasts = []
+    bumpable = []
     finished = Deferred()
-    iterators = [enumerate(escrow['schedule']) for escrow in escrows]
-    for index in transactions:
-        finished.addCallback(
-            create_transaction,
-            escrow=escrows[index],
-            index=(iterators[index].next())[0]
-        )
+    for depth in xrange(0, max([plan['depth'] + 1 for plan in plans] + [0])):
+        finished.addCallback(sign_depth, depth=depth, broadcasts=broadcasts)
+    finished.addCallback(wait_for_broadcasts, broadcasts=broadcasts)
+    finished.addCallback(keep_bumping)
+    finished.addCallback(report_slip)
     finished.addCallback(_debug_done)
-    finished.callback(0.0)
+    finished.callback(None)
     return finished
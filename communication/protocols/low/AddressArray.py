@@ -0,0 +1,111 @@
+""" CoinParty - Address Array
+    A packed representation of arrays of (encrypted) output addresses.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from array import array
+
+
+class AddressArray(object):
+    """ Array of byte strings that are stored in a single contiguous buffer,
+        delimited by an array of offsets. Entries are only materialized as
+        strings when accessed. Permutations and slices (see take) copy the
+        entries' bytes from buffer to buffer without creating a string
+        object per entry. """
+
+    def __init__(self, entries=()):
+        self._buffer = bytearray()
+        self._offsets = array('L', [0])
+        self.extend(entries)
+
+    def append(self, entry):
+        self._buffer += entry
+        self._offsets.append(len(self._buffer))
+        return
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+        return
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _view(self, i):
+        return memoryview(self._buffer)[self._offsets[i]:self._offsets[i + 1]]
+
+    def __getitem__(self, i):
+        if (isinstance(i, slice)):
+            return self.take(xrange(*i.indices(len(self))))
+        if (i < 0):
+            i += len(self)
+        if (i < 0 or i >= len(self)):
+            raise IndexError('address_index_out_of_range')
+        return self._view(i).tobytes()
+
+    def __iter__(self):
+        for i in xrange(0, len(self)):
+            yield self._view(i).tobytes()
+
+    @staticmethod
+    def fromBuffer(data, lengths):
+        """ Create an array from the concatenation of its entries (data) and
+            their lengths, e.g., as received within a message. """
+        result = AddressArray()
+        offset = 0
+        for length in lengths:
+            offset += length
+            result._offsets.append(offset)
+        if (offset > len(data)):
+            raise ValueError('address_buffer_too_short')
+        result._buffer += data[:offset]
+        return result
+
+    def getLength(self, i):
+        return self._offsets[i + 1] - self._offsets[i]
+
+    def getLengths(self):
+        return array('L', [self._offsets[i + 1] - self._offsets[i] for i in xrange(0, len(self))])
+
+    def getBufferLength(self):
+        return len(self._buffer)
+
+    def getBuffer(self):
+        """ Return the concatenation of all entries. """
+        return memoryview(self._buffer)
+
+    def take(self, indices):
+        """ Return a new array holding the entries at the given indices, in
+            that order. This is used to apply permutations. """
+        result = AddressArray()
+        for i in indices:
+            result._buffer += self._view(i)
+            result._offsets.append(len(result._buffer))
+        return result
+
+    @staticmethod
+    def concatenate(arrays):
+        result = AddressArray()
+        for a in arrays:
+            if (not isinstance(a, AddressArray)):
+                result.extend(a)
+                continue
+            shift = len(result._buffer)
+            result._buffer += a._buffer
+            result._offsets.extend([offset + shift for offset in a._offsets[1:]])
+        return result
@@ -77,12 +77,21 @@ def ripemd_bc_checksum(ripe_hash):
     return hashlib.sha256(hashlib.sha256(ripe_hash).digest()).digest()[:4]
 
 
-def computeBitcoinAddress(pubkey, using_testnet):
+def computeHash160(pubkey):
     hash256 = hashlib.sha256(pubkey).digest()
     hasher160 = hashlib.new('ripemd160')
     hasher160.update(hash256)
-    hash160 = hasher160.digest()
+    return hasher160.digest()
+
+
+def computeBitcoinAddress(pubkey, using_testnet):
+    hash160 = computeHash160(pubkey)
     addr_raw = get_version_byte(using_testnet) + hash160
     addr_raw_checksum = addr_raw + ripemd_bc_checksum(addr_raw)
     addr = base58.encode(addr_raw_checksum).encode('utf8')
-    return addr
\ No newline at end of file
+    return addr
+
+def computeScriptPubKey(pubkey):
+    """ Return the hex presentation of the P2PKH output script paying to
+        pubkey, as reported by bitcoind in scriptPubKey['hex']. """
+    return '76a914' + hexlify(computeHash160(pubkey)) + '88ac'
@@ -0,0 +1,183 @@
+""" CoinParty - Chain Notifier
+    Inform interested parties about new blocks and transactions as soon as
+    bitcoind learns about them, instead of having them poll bitcoind.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+
+from hashlib import sha256
+
+from CoinPartyProxy import Proxy
+from ..state.BaseState import mstate
+from log import Logger
+log = Logger('notifier')
+
+try:
+    from txzmq import ZmqFactory, ZmqEndpoint, ZmqSubConnection
+except ImportError:
+    ZmqSubConnection = None
+
+""" Interval (in seconds) in which the local notifier checks for new blocks.
+    Blocks arrive every ten minutes on average, hence this keeps idle RPC
+    traffic low while still noticing new blocks in time. """
+LOCAL_POLLING_INTERVAL = 60
+
+
+class ChainNotifier(object):
+    """ Interface of a source of block and transaction notifications.
+        Subscribers are called as f(event, data), where event is either
+        'block' (data: block hash) or 'tx' (data: raw transaction). """
+
+    def __init__(self):
+        self._subscribers = []
+        self._running = False
+
+    def subscribe(self, f):
+        self._subscribers.append(f)
+        if (not self._running):
+            self._running = True
+            self.start()
+        return
+
+    def unsubscribe(self, f):
+        if (f in self._subscribers):
+            del self._subscribers[self._subscribers.index(f)]
+        if (self._running and len(self._subscribers) == 0):
+            self._running = False
+            self.stop()
+        return
+
+    def notify(self, event, data):
+        for f in list(self._subscribers):
+            try:
+                f(event, data)
+            except Exception as e:
+                log.error('Notification subscriber failed: ' + str(e))
+        return
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class LocalChainNotifier(ChainNotifier):
+    """ Stand-in for setups without ZeroMQ. Periodically checks the hash of
+        the best block, which is a single cheap RPC call issued off the
+        reactor thread, and notifies subscribers once it changed.
+        Transactions are not announced. """
+
+    def __init__(self, proxy, interval=LOCAL_POLLING_INTERVAL):
+        super(LocalChainNotifier, self).__init__()
+        self._proxy = proxy
+        self._interval = interval
+        self._best_block = None
+        self._loopcall = None
+
+    def _check_best_block(self):
+        def _compare(best_block):
+            if (best_block != self._best_block):
+                self._best_block = best_block
+                self.notify('block', best_block)
+            return
+
+        def _failed(failure):
+            # Keep polling; bitcoind may be back at the next check
+            log.warning('Could not obtain best block hash: ' + str(failure.getErrorMessage()))
+            return
+
+        d = deferToThread(self._proxy.getbestblockhash)
+        d.addCallbacks(_compare, _failed)
+        return d
+
+    def start(self):
+        self._best_block = None
+        self._loopcall = LoopingCall(self._check_best_block)
+        self._loopcall.start(self._interval, now=False)
+
+    def stop(self):
+        if (self._loopcall is not None and self._loopcall.running):
+            self._loopcall.stop()
+        self._loopcall = None
+
+
+if (ZmqSubConnection is not None):
+
+    class BitcoindSubConnection(ZmqSubConnection):
+        """ bitcoind publishes three-part messages (topic, body, sequence
+            number), which txzmq's default parsing does not expect. """
+
+        def messageReceived(self, message):
+            self.gotMessage(message[1], message[0])
+
+
+class ZmqChainNotifier(ChainNotifier):
+    """ Receive notifications published by bitcoind via zmqpubrawblock and
+        zmqpubrawtx. """
+
+    def __init__(self, endpoint):
+        super(ZmqChainNotifier, self).__init__()
+        self._endpoint = endpoint
+        self._factory = None
+        self._connection = None
+
+    def _received(self, body, topic):
+        if (topic == 'rawblock'):
+            # The block hash is the (reversed) double SHA-256 of the 80-byte block header
+            block_hash = sha256(sha256(body[:80]).digest()).digest()[::-1].encode('hex')
+            self.notify('block', block_hash)
+        elif (topic == 'rawtx'):
+            self.notify('tx', body)
+        return
+
+    def start(self):
+        self._factory = ZmqFactory()
+        self._connection = BitcoindSubConnection(self._factory, ZmqEndpoint('connect', self._endpoint))
+        self._connection.gotMessage = self._received
+        self._connection.subscribe('rawblock')
+        self._connection.subscribe('rawtx')
+        log.info('Subscribed to bitcoind notifications at ' + self._endpoint)
+
+    def stop(self):
+        if (self._connection is not None):
+            self._connection.shutdown()
+        self._connection = None
+        self._factory = None
+
+
+_chain_notifier = None
+
+
+def getChainNotifier():
+    """ Return the process-wide notifier, which is shared by all mixnets.
+        ZeroMQ is used if an endpoint is configured and txzmq is available,
+        otherwise the local stand-in is used. """
+    global _chain_notifier
+    if (_chain_notifier is None):
+        endpoint = mstate.getNotificationEndpoint()
+        if (endpoint is not None and ZmqSubConnection is None):
+            log.warning('txzmq is not installed. Falling back to local block notifications.')
+        if (endpoint is not None and ZmqSubConnection is not None):
+            _chain_notifier = ZmqChainNotifier(endpoint)
+        else:
+            # Own connection, as the shared proxy is not safe to use from the thread pool
+            _chain_notifier = LocalChainNotifier(Proxy())
+    return _chain_notifier
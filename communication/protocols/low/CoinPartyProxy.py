@@ -22,12 +22,33 @@
 from bitcoin.rpc import Proxy as BitcoinlibProxy, JSONRPCError
 from bitcoin.core import x
 from bitcoin import SelectParams
+from collections import OrderedDict
 from ..state.BaseState import mstate
 from log import Logger
 log = Logger('proxy')
 
 HTTP_TIMEOUT = 30
 
+""" getblock verbosity that includes fully decoded transactions (bitcoind >= 0.15). """
+GETBLOCK_VERBOSITY_TXS = 2
+
+""" Error codes of bitcoind rejecting the verbosity, i.e., RPC_TYPE_ERROR
+    and RPC_INVALID_PARAMETER. """
+GETBLOCK_VERBOSITY_UNSUPPORTED = (-3, -8)
+
+""" Errors of sendrawtransaction that do not fail a broadcast. RPC_VERIFY_ERROR
+    is returned for transactions whose inputs are not known (yet), e.g.,
+    if the parent of a payout has not been relayed to us yet. The
+    transaction is broadcast again later. RPC_VERIFY_ALREADY_IN_CHAIN tells
+    that a transaction has been included in a block already, e.g., since
+    another mixing peer broadcast it before. """
+RPC_VERIFY_ERROR = -25
+RPC_VERIFY_ALREADY_IN_CHAIN = -27
+
+""" Number of recently scanned blocks kept by the chain scanner. Determines
+    the depth of chain reorganizations that can be handled. """
+BLOCK_CACHE_SIZE = 32
+
 
 class Proxy(BitcoinlibProxy):
     """ Extend the BitcoinlibProxy by calls that CoinParty requires to perform during the Commitment /transaction phases. """
@@ -46,6 +67,8 @@ class Proxy(BitcoinlibProxy):
         except:
             raise RuntimeError('bitcoind is not running.')
         self.testnet = True if (info['testnet']) else False
+        self._batch_id = 0
+        self._getblock_with_txs = None  # Unknown until the first block is fetched
 
     def getbestblockhash(self):
         """ Return hash of the most recent block in best-block-chain. """
@@ -55,6 +78,14 @@ class Proxy(BitcoinlibProxy):
             raise IndexError('%s.getblockhash(): %s (%d)' %
                              (self.__class__.__name__, ex.error['message'], ex.error['code']))
 
+    def getblockhash(self, height):
+        """ Return hash of the block at the given height of the best-block-chain. """
+        try:
+            return x(self._call('getblockhash', height)).encode('hex')
+        except JSONRPCError as ex:
+            raise IndexError('%s.getblockhash(): %s (%d)' %
+                             (self.__class__.__name__, ex.error['message'], ex.error['code']))
+
     def getblock(self, block_hash):
         """ Return the verbose JSON presentation of a block.
             This overwrites python-bitcoinlib's getblock method, which
@@ -66,6 +97,57 @@ class Proxy(BitcoinlibProxy):
             raise IndexError('%s.getblock(): %s (%d)' %
                              (self.__class__.__name__, ex.error['message'], ex.error['code']))
 
+    def getrawtransactions(self, txids, verbose=True):
+        """ Fetch several transactions within a single JSON-RPC batch request.
+            The result is ordered like txids. As in getrawtransaction, unknown
+            transactions are returned as None when using the testnet. """
+        if (len(txids) == 0):
+            return []
+        first_id = self._batch_id + 1
+        calls = []
+        for txid in txids:
+            self._batch_id += 1
+            calls.append({
+                'version' : '1.1',
+                'method'  : 'getrawtransaction',
+                'params'  : [txid, 1 if verbose else 0],
+                'id'      : self._batch_id
+            })
+        responses = self._batch(calls)
+
+        # Responses of a batch may arrive in arbitrary order
+        txs = [None] * len(txids)
+        for response in responses:
+            if (response['error'] is not None):
+                if (self.testnet):
+                    continue
+                raise IndexError('%s.getrawtransactions(): %s (%d)' %
+                                 (self.__class__.__name__, response['error']['message'], response['error']['code']))
+            txs[response['id'] - first_id] = response['result']
+        return txs
+
+    def getblocktransactions(self, block):
+        """ Return the decoded transactions of a block (as obtained by
+            getblock). If bitcoind supports it, all transactions are
+            delivered together with the block; otherwise, they are
+            requested using a single batch request. """
+        if (self._getblock_with_txs is not False):
+            try:
+                txs = self._call('getblock', block['hash'], GETBLOCK_VERBOSITY_TXS)['tx']
+                self._getblock_with_txs = True
+            except JSONRPCError as ex:
+                # Only a rejected verbosity tells that bitcoind is too old
+                if (self._getblock_with_txs is not None or ex.error.get('code') not in GETBLOCK_VERBOSITY_UNSUPPORTED):
+                    raise
+                log.info('bitcoind does not support getblock verbosity 2. Falling back to batch requests.')
+                self._getblock_with_txs = False
+            else:
+                # Transactions embedded into a block do not refer to the block itself
+                for tx in txs:
+                    tx['blockhash'] = block['hash']
+                return txs
+        return self.getrawtransactions(block['tx'])
+
     def getrawtransaction(self, txid, verbose=True):
         try:
             return self._call('getrawtransaction', txid, 1 if verbose else 0)
@@ -76,18 +158,244 @@ class Proxy(BitcoinlibProxy):
                 raise IndexError('%s.getrawtransaction(): %s (%d)' %
                                  (self.__class__.__name__, ex.error['message'], ex.error['code']))
 
+    def listsinceblock(self, block_hash, target_confirmations=1, include_watchonly=True):
+        """ Return all wallet transactions (including watch-only addresses)
+            that occured in blocks after the block referred to by block_hash. """
+        try:
+            return self._call('listsinceblock', block_hash, target_confirmations, include_watchonly)
+        except JSONRPCError as ex:
+            raise IndexError('%s.listsinceblock(): %s (%d)' %
+                             (self.__class__.__name__, ex.error['message'], ex.error['code']))
+
+    def getrawmempool(self):
+        """ Return the txids of all transactions in the mempool (hex). """
+        return self._call('getrawmempool')
+
     def sendrawtransaction(self, tx):
         try:
             return self._call('sendrawtransaction', str(tx))
         except JSONRPCError as ex:
-            """ Error -25 is for attempted double spending (sending the same transaction twice).
-                This is deliberately done by CoinParty as mixing peers broadcast each
-                transaction concurrently. Thus, we just consume this error. """
-            if (ex.error['code'] != -25):
+            """ Mixing peers broadcast each transaction concurrently, hence it
+                may be known already or depend on a transaction that has not
+                reached us yet. Thus, we just log these errors. """
+            if (ex.error['code'] == RPC_VERIFY_ERROR):
+                log.warning('Inputs of the transaction are not known yet: ' + ex.error['message'])
+            elif (ex.error['code'] == RPC_VERIFY_ALREADY_IN_CHAIN):
+                log.info('Transaction has been included in a block already.')
+            else:
                 raise IndexError('%s.sendrawtransaction(): %s (%d)\nTransaction was:\n%s' %
                                  (self.__class__.__name__, ex.error['message'], ex.error['code'], str(tx)))
 
 
+class ChainScanner(object):
+    """ Process-wide scanner of the blockchain that is shared by all mixnets
+        of this mixing peer. Each new block is fetched and decoded only once;
+        its outputs are then handed to all registered commitment watchers.
+        A bounded cache of recently scanned blocks (least recently used ones
+        are evicted) allows for replaying blocks to late watchers and for
+        rolling back blocks that left the main chain.
+        The scanner also keeps an index of the main chain's recent block
+        hashes by height. Given the block that includes a transaction, its
+        number of confirmations is thus derived from the height of the tip. """
+
+    def __init__(self, proxy, use_wallet=None, cache_size=BLOCK_CACHE_SIZE):
+        self._proxy = proxy
+        self._use_wallet = use_wallet
+        self._cache_size = cache_size
+        self._blocks = OrderedDict()  # Block hash -> compact block, in order of use
+        self._heights = dict()  # Height -> hash of the main chain's block
+        self._watchers = []
+        self._tip = None
+        self._tip_height = None
+        self._wallet_tip = None
+
+    def _usingWallet(self):
+        # The configuration is read after this module has been loaded
+        return mstate.watchingAddresses() if (self._use_wallet is None) else self._use_wallet
+
+    def _cacheBlock(self, block):
+        self._blocks.pop(block['hash'], None)
+        self._blocks[block['hash']] = block
+        while (len(self._blocks) > self._cache_size):
+            self._blocks.popitem(last=False)
+        return block
+
+    def _cachedBlock(self, block_hash):
+        block = self._blocks.pop(block_hash, None)
+        if (block is not None):
+            self._blocks[block_hash] = block
+        return block
+
+    def _fetchBlock(self, block_hash):
+        """ Fetch a block and reduce it to what watchers are interested in.
+            Its outputs are only fetched once they are actually needed. """
+        block = self._proxy.getblock(block_hash)
+        return {
+            'hash'     : block['hash'],
+            'height'   : block['height'],
+            'previous' : block.get('previousblockhash'),
+            'txids'    : block['tx'],
+            'outputs'  : None
+        }
+
+    def _fetchOutputs(self, block):
+        if (block['outputs'] is not None):
+            return block
+        log.info('Checking block ' + block['hash'] + '...')
+        outputs = []
+        for tx in self._proxy.getblocktransactions({'hash' : block['hash'], 'tx' : block['txids']}):
+            if (tx is None):
+                # In the testnet, transactions may apparently be broken
+                if (self._proxy.testnet):
+                    log.warning('Found invalid transaction in testnet.')
+                    continue
+                else:
+                    raise RuntimeError('invalid_transaction')
+            for output in tx['vout']:
+                try:
+                    outputs.append((tx['txid'], int(output['n']), output['scriptPubKey']['hex'], output['value']))
+                except KeyError:
+                    continue
+        block['outputs'] = outputs
+        return block
+
+    def _setTip(self, block):
+        self._tip = block['hash']
+        self._tip_height = block['height']
+        self._heights[block['height']] = block['hash']
+        # Blocks that deep are not affected by reorganizations we can handle anyway
+        for height in [h for h in self._heights if h <= block['height'] - self._cache_size]:
+            del self._heights[height]
+        return
+
+    def register(self, watcher, block_hash):
+        """ Hand all blocks after the one referred to by block_hash to watcher. """
+        self._watchers.append(watcher)
+        if (self._tip is None):
+            self._wallet_tip = block_hash
+            self._setTip(self._cacheBlock(self._fetchBlock(block_hash)))
+            return
+        # Replay those cached blocks the watcher has missed
+        missed = []
+        block = self._cachedBlock(self._tip)
+        while (block is not None and block['hash'] != block_hash):
+            missed.append(block)
+            block = self._cachedBlock(block['previous'])
+        if (block is None):
+            return  # The watcher's block is unknown (and thus older than any block scanned)
+        watcher.refresh()
+        for block in reversed(missed):
+            self._fetchOutputs(block)
+            watcher.matchOutputs(block, block['outputs'])
+        return
+
+    def unregister(self, watcher):
+        if (watcher in self._watchers):
+            del self._watchers[self._watchers.index(watcher)]
+        return
+
+    def getTip(self):
+        return self._tip
+
+    def getTipHeight(self):
+        return self._tip_height
+
+    def getConfirmations(self, block_hash, height):
+        """ Return the number of confirmations of a block as of the last scan,
+            i.e., 0 if the block is not part of the main chain (anymore). """
+        if (self._tip_height is None or height is None or height > self._tip_height):
+            return 0
+        if (height > self._tip_height - self._cache_size):
+            main_hash = self._heights.get(height)
+            if (main_hash is None):
+                # Evicted from the index; this does not happen in the common case
+                main_hash = self._proxy.getblockhash(height)
+                self._heights[height] = main_hash
+            if (main_hash != block_hash):
+                return 0
+        return self._tip_height - height + 1
+
+    def scan(self):
+        """ Bring all registered watchers up to date with the best block chain. """
+        if (self._tip is None):
+            return None
+        for watcher in self._watchers:
+            watcher.refresh()
+        connected = self._followChain()
+        if (self._usingWallet()):
+            self._scanWallet()
+        else:
+            self._scanBlocks(connected)
+        return self._tip
+
+    def _followChain(self):
+        """ Update the tip to the best block and return the newly connected
+            blocks. Watchers are informed about blocks that left the main chain. """
+        best_hash = self._proxy.getbestblockhash()
+        if (best_hash == self._tip):
+            return []
+
+        # Walk back from the best block until we reach a block we know
+        lowest_height = min(b['height'] for b in self._blocks.itervalues())
+        connected = []
+        block = self._cachedBlock(best_hash)
+        if (block is None):
+            block = self._fetchBlock(best_hash)
+        while (block['hash'] not in self._blocks and block['height'] > lowest_height):
+            connected.append(block)
+            block = self._fetchBlock(block['previous'])
+
+        # Blocks between our tip and the fork point left the main chain
+        if (block['hash'] in self._blocks):
+            disconnected = []
+            tip = self._cachedBlock(self._tip)
+            while (tip is not None and tip['hash'] != block['hash']):
+                disconnected.append(tip)
+                tip = self._cachedBlock(tip['previous'])
+            for tip in disconnected:
+                log.warning('Block ' + tip['hash'] + ' left the main chain.')
+                for watcher in self._watchers:
+                    watcher.blockDisconnected(tip)
+                self._blocks.pop(tip['hash'], None)
+                if (self._heights.get(tip['height']) == tip['hash']):
+                    del self._heights[tip['height']]
+        else:
+            connected.append(block)
+            log.critical('Chain reorganization is deeper than the block cache.')
+
+        connected.reverse()
+        for block in connected:
+            self._cacheBlock(block)
+            self._setTip(block)
+        return connected
+
+    def _scanWallet(self):
+        result = self._proxy.listsinceblock(self._wallet_tip)
+        entries = result['transactions']
+        for entry in entries:
+            # Older versions of bitcoind do not report the block's height
+            if ('blockhash' not in entry or 'blockheight' in entry):
+                continue
+            if (entry['blockhash'] in self._blocks):
+                entry['blockheight'] = self._blocks[entry['blockhash']]['height']
+            elif (entry.get('confirmations', 0) > 0):
+                entry['blockheight'] = self._tip_height - entry['confirmations'] + 1
+        for watcher in self._watchers:
+            watcher.matchWalletTransactions(entries)
+        self._wallet_tip = result['lastblock']
+        return
+
+    def _scanBlocks(self, connected):
+        # Unless anybody is interested in them, outputs are fetched lazily
+        watchers = [w for w in self._watchers if w.isWatchingAny()]
+        for block in connected:
+            if (len(watchers) > 0):
+                self._fetchOutputs(block)
+            for watcher in self._watchers:
+                watcher.matchOutputs(block, block['outputs'])
+        return
+
+
 # Define usage of mainnet or testnet
 SelectParams('testnet' if mstate.usingTestnet() else 'mainnet')
 
@@ -98,6 +406,8 @@ except BaseException as e:
     log.critical('Could not initialize bitcoind proxy: ' + str(e))
     exit(1)
 
+chain_scanner = ChainScanner(bitcoind)
+
 
 def transaction_confirmed(txid, confirmations=6):
     """ Check whether the transaction referred to by txid has sufficiently
@@ -0,0 +1,190 @@
+""" CoinParty - Commitment Watcher
+    Keep track of the escrow addresses that still wait for their commitment
+    transaction and find those transactions in the blockchain.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from log import Logger
+log = Logger('watcher')
+
+WALLET_LABEL = 'coinparty'
+
+
+class CommitmentWatcher(object):
+    """ Match transaction outputs against the watched escrow addresses.
+        Escrows are indexed by the hex presentation of their P2PKH output
+        script, so each output is checked by a single hash lookup without
+        decoding its address.
+        If use_wallet is set, watched addresses are imported into bitcoind's
+        wallet (watch-only), so that they can be found via listsinceblock.
+        Blocks and wallet transactions are fed in by the process-wide chain
+        scanner; found transactions are collected until they are fetched via
+        popFoundTransactions.
+        For each found transaction, the block including it is remembered
+        until it is untracked. If that block leaves the main chain, the
+        transaction is looked up by its txid in the blocks that follow.
+        If get_version is given, the watched addresses are only synchronized
+        with their source once the version it returns changes. """
+
+    def __init__(self, proxy, use_wallet=False, get_addresses=None, get_script_pubkey=None, get_version=None):
+        self._proxy = proxy
+        self._use_wallet = use_wallet
+        self._get_addresses = get_addresses
+        self._get_script_pubkey = get_script_pubkey
+        self._get_version = get_version
+        self._version = None
+        self._scripts = dict()  # scriptPubKey (hex) -> escrow address
+        self._address_scripts = dict()  # escrow address -> scriptPubKey (hex)
+        self._addresses = set()
+        self._imported = set()
+        self._found = []
+        self._inclusions = dict()  # txid -> (block hash, height) or None
+
+    def usingWallet(self):
+        return self._use_wallet
+
+    def isWatching(self, address):
+        return address in self._addresses
+
+    def isWatchingAny(self):
+        return len(self._addresses) > 0
+
+    def watch(self, address, script_pubkey):
+        if (address in self._addresses):
+            return
+        self._addresses.add(address)
+        self._scripts[script_pubkey] = address
+        self._address_scripts[address] = script_pubkey
+        if (self._use_wallet and address not in self._imported):
+            # Escrow addresses are fresh, thus there is nothing to rescan
+            self._proxy.importaddress(address, WALLET_LABEL, False)
+            self._imported.add(address)
+        return
+
+    def unwatch(self, address):
+        if (address not in self._addresses):
+            return
+        self._addresses.remove(address)
+        del self._scripts[self._address_scripts.pop(address)]
+        return
+
+    def update(self, addresses, get_script_pubkey):
+        """ Watch exactly the given addresses. The output script of newly
+            watched addresses is obtained via get_script_pubkey(address). """
+        addresses = set(addresses)
+        for address in self._addresses - addresses:
+            self.unwatch(address)
+        for address in addresses - self._addresses:
+            self.watch(address, get_script_pubkey(address))
+        return
+
+    def refresh(self):
+        """ Synchronize the watched addresses with their source, if known. """
+        if (self._get_addresses is None):
+            return
+        if (self._get_version is not None):
+            version = self._get_version()
+            if (version == self._version):
+                return
+            self._version = version
+        self.update(self._get_addresses(), self._get_script_pubkey)
+        return
+
+    def _included(self, txid, block_hash, height):
+        self._inclusions[txid] = None if (block_hash is None) else (block_hash, height)
+        return
+
+    def _matchTrackedTxids(self, block):
+        """ Find tracked transactions that were moved to another block. """
+        moved = [txid for txid in self._inclusions if self._inclusions[txid] is None]
+        if (len(moved) == 0):
+            return
+        txids = set(block['txids'])
+        for txid in moved:
+            if (txid in txids):
+                log.info('Transaction ' + txid + ' was included in block ' + block['hash'] + '.')
+                self._included(txid, block['hash'], block['height'])
+        return
+
+    def matchOutputs(self, block, outputs):
+        """ Collect those outputs of a block that pay to a watched address.
+            Outputs are given as tuples (txid, n, scriptPubKey (hex), value). """
+        self._matchTrackedTxids(block)
+        if (len(self._addresses) == 0 or outputs is None):
+            return
+        for (txid, n, script, value) in outputs:
+            address = self._scripts.get(script)
+            if (address is None):
+                continue
+            log.info('Found transaction to "' + address + '"!')
+            log.info('txid: ' + txid + '; value: ' + str(value))
+            self._included(txid, block['hash'], block['height'])
+            self._found.append({
+                'txid'      : txid,
+                'addr'      : address,
+                'vout'      : n,
+                'value'     : value,
+                'blockhash' : block['hash']
+            })
+        return
+
+    def matchWalletTransactions(self, entries):
+        """ Collect those entries of listsinceblock that pay to a watched address. """
+        for entry in entries:
+            # Like block scanning, only consider transactions that are mined already
+            if (entry['category'] != 'receive' or 'blockhash' not in entry):
+                continue
+            if (entry['txid'] in self._inclusions):
+                self._included(entry['txid'], entry['blockhash'], entry.get('blockheight'))
+            if (entry['address'] not in self._addresses):
+                continue
+            log.info('Found transaction to "' + entry['address'] + '"!')
+            log.info('txid: ' + entry['txid'] + '; value: ' + str(entry['amount']))
+            self._included(entry['txid'], entry['blockhash'], entry.get('blockheight'))
+            self._found.append({
+                'txid'      : entry['txid'],
+                'addr'      : entry['address'],
+                'vout'      : int(entry['vout']),
+                'value'     : entry['amount'],
+                'blockhash' : entry['blockhash']
+            })
+        return
+
+    def blockDisconnected(self, block):
+        """ Forget about transactions found in a block that left the main chain. """
+        self._found = [tx for tx in self._found if tx['blockhash'] != block['hash']]
+        for txid in self._inclusions:
+            if (self._inclusions[txid] is not None and self._inclusions[txid][0] == block['hash']):
+                log.warning('Transaction ' + txid + ' is unconfirmed again.')
+                self._inclusions[txid] = None
+        return
+
+    def getInclusion(self, txid):
+        """ Return (block hash, height) of the block including a found
+            transaction, or (None, None) if it is currently not included. """
+        inclusion = self._inclusions.get(txid)
+        return (None, None) if (inclusion is None) else inclusion
+
+    def untrack(self, txid):
+        self._inclusions.pop(txid, None)
+        return
+
+    def popFoundTransactions(self):
+        found = self._found
+        self._found = []
+        return found
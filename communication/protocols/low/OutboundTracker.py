@@ -0,0 +1,203 @@
+""" CoinParty - Outbound Tracker
+    Keep track of broadcast output transactions until they are confirmed.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.internet.task import LoopingCall
+
+from collections import OrderedDict
+import bitcoin as bc
+
+from log import Logger
+log = Logger('outbound')
+
+""" Interval (in seconds) in which tracked transactions are checked. """
+TRACKING_PERIOD = 30
+
+""" Number of confirmations after which a transaction is no longer tracked. """
+TRACKING_CONFIRMATIONS = 3
+
+
+class OutboundTracker(object):
+    """ Follow broadcast transactions until they are confirmed. Inclusion in
+        blocks is learnt from the chain scanner, for which the tracker acts
+        as a watcher that is only interested in txids. Additionally, the
+        mempool is fetched once per check; transactions that are neither
+        included nor in the mempool (anymore) are broadcast again.
+        A transaction may be tracked with a bump function, which is called
+        as bump(tip height, number of previous bumps) in each check while
+        it is unconfirmed. It returns None, or a Deferred firing with a
+        replacement of the transaction paying a higher fee. Any version of
+        a transaction confirms it. A pending bump is cancelled as soon as a
+        version is included in a block, since other mixing peers may have
+        learnt about the inclusion before the bump was due and never join
+        its signing. """
+
+    def __init__(self, proxy, scanner, clock=reactor, confirmations=TRACKING_CONFIRMATIONS):
+        self._proxy = proxy
+        self._scanner = scanner
+        self._clock = clock
+        self._confirmations = confirmations
+        self._records = OrderedDict()  # txid of first version -> record
+        self._versions = dict()  # txid of any version -> txid of first version
+        self._loopcall = None
+
+    def track(self, tx, bump=None):
+        """ Track the serialized transaction tx, which has been broadcast
+            already. Return a Deferred firing with the txid of the version
+            that has been confirmed. """
+        txid = bc.core.b2lx(bc.core.Hash(bc.core.x(tx)))
+        if (txid in self._versions):
+            return self._records[self._versions[txid]]['deferred']
+        self._records[txid] = {
+            'key'       : txid,
+            'txs'       : {txid : tx},
+            'current'   : txid,
+            'inclusion' : None,  # (block hash, height, txid)
+            'bump'      : bump,
+            'bumps'     : 0,
+            'pending'   : None,  # Deferred of the bump being signed
+            'deferred'  : Deferred()
+        }
+        self._versions[txid] = txid
+        if (self._loopcall is None):
+            self._scanner.register(self, self._scanner.getTip())
+            self._loopcall = LoopingCall(self.check)
+            self._loopcall.clock = self._clock
+            self._loopcall.start(TRACKING_PERIOD, now=False)
+        return self._records[txid]['deferred']
+
+    def release(self, tx, bump=None):
+        """ Track the serialized transaction tx (see track) and broadcast it
+            afterwards. A failed broadcast is only logged, as the next check
+            broadcasts the transaction again. """
+        deferred = self.track(tx, bump)
+        self._broadcast(bc.core.b2lx(bc.core.Hash(bc.core.x(tx))), tx)
+        return deferred
+
+    def getNumberTracked(self):
+        return len(self._records)
+
+    """ Watcher interface used by the chain scanner """
+
+    def refresh(self):
+        return
+
+    def isWatchingAny(self):
+        return False  # Outputs are not needed
+
+    def _included(self, txid, block_hash, height):
+        record = self._records.get(self._versions.get(txid))
+        if (record is None):
+            return
+        log.info('Output transaction ' + txid + ' was included in block ' + block_hash + '.')
+        record['inclusion'] = (block_hash, height, txid)
+        if (record['pending'] is not None):
+            record['pending'].cancel()
+        return
+
+    def matchOutputs(self, block, outputs):
+        for txid in block['txids']:
+            if (txid in self._versions):
+                self._included(txid, block['hash'], block['height'])
+        return
+
+    def matchWalletTransactions(self, entries):
+        for entry in entries:
+            if ('blockhash' in entry and entry['txid'] in self._versions):
+                self._included(entry['txid'], entry['blockhash'], entry.get('blockheight'))
+        return
+
+    def blockDisconnected(self, block):
+        for record in self._records.itervalues():
+            if (record['inclusion'] is not None and record['inclusion'][0] == block['hash']):
+                log.warning('Output transaction ' + record['inclusion'][2] + ' is unconfirmed again.')
+                record['inclusion'] = None
+        return
+
+    """ Periodic check of all tracked transactions """
+
+    def _broadcast(self, txid, tx):
+        try:
+            self._proxy.sendrawtransaction(tx)
+        except Exception as e:
+            log.error('Broadcasting ' + txid + ' failed: ' + str(e))
+        return
+
+    def _bumped(self, tx, record):
+        record['pending'] = None
+        if (tx is None):
+            return
+        txid = bc.core.b2lx(bc.core.Hash(bc.core.x(tx)))
+        record['bumps'] += 1
+        record['txs'][txid] = tx
+        record['current'] = txid
+        self._versions[txid] = record['key']
+        log.info('Replacing output transaction by ' + txid + ' (bump #' + str(record['bumps']) + ').')
+        self._broadcast(txid, tx)
+        return
+
+    def _bump_failed(self, f, record):
+        record['pending'] = None
+        if (f.check(CancelledError)):
+            log.info('Cancelled bumping the fee of ' + record['current'] + '.')
+            return None
+        log.error('Bumping the fee of ' + record['current'] + ' failed: ' + str(f.getErrorMessage()))
+        return None
+
+    def _done(self, key):
+        record = self._records.pop(key)
+        for txid in record['txs']:
+            del self._versions[txid]
+        record['deferred'].callback(record['inclusion'][2])
+        return
+
+    def check(self):
+        try:
+            self._scanner.scan()
+            mempool = set(self._proxy.getrawmempool())
+        except BaseException as e:
+            log.error('Checking output transactions failed: ' + str(e))
+            return
+        tip_height = self._scanner.getTipHeight()
+        for key in self._records.keys():
+            record = self._records[key]
+            if (record['inclusion'] is not None):
+                (block_hash, height, _) = record['inclusion']
+                if (self._scanner.getConfirmations(block_hash, height) >= self._confirmations):
+                    self._done(key)
+                continue
+            if (record['current'] not in mempool):
+                log.warning('Output transaction ' + record['current'] + ' is not in the mempool. Broadcasting it again.')
+                self._broadcast(record['current'], record['txs'][record['current']])
+            if (record['bump'] is not None and record['pending'] is None):
+                bumped = record['bump'](tip_height, record['bumps'])
+                if (bumped is not None):
+                    record['pending'] = bumped
+                    bumped.addCallbacks(
+                        self._bumped, self._bump_failed,
+                        callbackKeywords={'record' : record},
+                        errbackKeywords={'record' : record}
+                    )
+        if (len(self._records) == 0):
+            self._loopcall.stop()
+            self._loopcall = None
+            self._scanner.unregister(self)
+        return
@@ -0,0 +1,108 @@
+""" CoinParty - Parallel Decryption
+    Remove an ECIES layer from many output addresses using a process pool.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.threads import deferToThread
+
+from multiprocessing import Pool
+import pyelliptic
+
+from log import Logger
+log = Logger('decryption')
+
+""" Number of addresses decrypted by a worker at once. Fewer addresses than
+    that are decrypted right away, as using the pool does not pay off. """
+CHUNK_SIZE = 64
+
+CIPHERNAME = 'aes-256-cbc'
+
+_pool = None
+_pool_public_key = None
+_crypter = None  # Within the workers only
+
+
+def _initWorker(private_key_hex, public_key_hex):
+    """ Run once by each worker. The workers are forked with the keys in
+        place, so they never have to be sent to them. """
+    global _crypter
+    _crypter = pyelliptic.ECC(
+        curve='secp256k1',
+        privkey=private_key_hex.decode('hex'),
+        pubkey=public_key_hex.decode('hex')
+    )
+
+
+def _decryptChunk(chunk):
+    """ Run by the workers. """
+    return [_crypter.decrypt(address, ciphername=CIPHERNAME) for address in chunk]
+
+
+def startPool(workers, private_key_hex, public_key_hex):
+    """ Fork the worker processes, which decrypt with the given key pair.
+        This must happen before the reactor runs, as the workers would
+        otherwise inherit its connections and the locks of its threads.
+        If workers is 0, one worker per CPU is started. """
+    global _pool, _pool_public_key
+    if (reactor.running):
+        raise RuntimeError('pool_started_within_reactor')
+    if (_pool is not None):
+        raise RuntimeError('pool_already_started')
+    _pool = Pool(workers if (workers > 0) else None, _initWorker, (private_key_hex, public_key_hex))
+    _pool_public_key = public_key_hex
+    reactor.addSystemEventTrigger('before', 'shutdown', stopPool)
+
+
+def stopPool():
+    """ Let the workers finish pending chunks and shut them down. """
+    global _pool, _pool_public_key
+    if (_pool is None):
+        return
+    _pool.close()
+    _pool.join()
+    _pool = None
+    _pool_public_key = None
+
+
+def _concatenate(chunks):
+    result = []
+    for chunk in chunks:
+        result += chunk
+    return result
+
+
+def decryptAddresses(addresses, crypto_state, chunk_size=CHUNK_SIZE):
+    """ Decrypt each of the addresses using the key pair of crypto_state.
+        Return a Deferred firing with the plaintexts in the order of the
+        given addresses (or failing if any address cannot be decrypted).
+        The addresses are split into chunks, which are decrypted by a pool
+        of worker processes (see startPool). Pool.map is blocking and
+        preserves the order of chunks; it is thus waited for in a thread, so
+        that the reactor is not blocked and the result is passed back to the
+        reactor thread. Without a pool for the key pair, the addresses are
+        decrypted right away. """
+    if (len(addresses) < chunk_size or _pool is None or _pool_public_key != crypto_state.getPublicKey()):
+        crypter = crypto_state.getCrypter()
+        return maybeDeferred(lambda: [crypter.decrypt(address, ciphername=CIPHERNAME) for address in addresses])
+    chunks = [list(addresses[i:(i + chunk_size)]) for i in xrange(0, len(addresses), chunk_size)]
+    log.debug('Decrypting ' + str(len(addresses)) + ' addresses in ' + str(len(chunks)) + ' chunks.')
+    decrypted = deferToThread(_pool.map, _decryptChunk, chunks)
+    decrypted.addCallback(_concatenate)
+    return decrypted
@@ -0,0 +1,104 @@
+""" CoinParty - Payout Scheduler
+    Release scheduled payouts at their absolute release times.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+
+import heapq
+
+from log import Logger
+log = Logger('payouts')
+
+
+class PayoutScheduler(object):
+    """ Keep pending payouts in a heap ordered by their absolute release
+        time. Only a single timer is armed, namely for the earliest payout.
+        When it expires, all payouts that are due are dispatched
+        independently of each other, so that a slow payout does not delay
+        the following ones.
+        The slip of each payout, i.e., how late it was dispatched with
+        respect to its release time, is recorded. """
+
+    def __init__(self, clock=reactor):
+        self._clock = clock
+        self._heap = []  # (release time, sequence number, payout)
+        self._sequence = 0
+        self._call = None
+        self._dispatched = 0
+        self._slip_total = 0.0
+        self._slip_max = 0.0
+
+    def schedule(self, release_time, f, *a, **kw):
+        """ Call f(*a, **kw) at the absolute time release_time. Return a
+            Deferred firing with its result. """
+        d = Deferred()
+        heapq.heappush(self._heap, (release_time, self._sequence, (d, f, a, kw)))
+        self._sequence += 1
+        self._arm()
+        return d
+
+    def getNumberPending(self):
+        return len(self._heap)
+
+    def getNextReleaseTime(self):
+        return self._heap[0][0] if (len(self._heap) > 0) else None
+
+    def getSlipStatistics(self):
+        """ Return the number of dispatched payouts, their mean and maximum slip (in seconds). """
+        mean = (self._slip_total / self._dispatched) if (self._dispatched > 0) else 0.0
+        return (self._dispatched, mean, self._slip_max)
+
+    def stop(self):
+        """ Drop all pending payouts. Their Deferreds are cancelled. """
+        if (self._call is not None and self._call.active()):
+            self._call.cancel()
+        self._call = None
+        pending = self._heap
+        self._heap = []
+        for (_, _, (d, _, _, _)) in pending:
+            d.cancel()
+        return
+
+    def _arm(self):
+        if (len(self._heap) == 0):
+            return
+        delay = max(self._heap[0][0] - self._clock.seconds(), 0)
+        if (self._call is not None and self._call.active()):
+            if (self._call.getTime() <= self._heap[0][0]):
+                return
+            self._call.reset(delay)
+            return
+        self._call = self._clock.callLater(delay, self._dispatch)
+        return
+
+    def _dispatch(self):
+        self._call = None
+        now = self._clock.seconds()
+        while (len(self._heap) > 0 and self._heap[0][0] <= now):
+            (release_time, _, (d, f, a, kw)) = heapq.heappop(self._heap)
+            slip = now - release_time
+            self._dispatched += 1
+            self._slip_total += slip
+            self._slip_max = max(self._slip_max, slip)
+            if (slip > 1):
+                log.warning('Payout was released ' + str(slip) + ' seconds late.')
+            maybeDeferred(f, *a, **kw).chainDeferred(d)
+        self._arm()
+        return
@@ -20,21 +20,26 @@
     along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
 
 from struct import Struct as struct
+from array import array
+from sys import byteorder
 from exceptions import AbstractClassError
+from AddressArray import AddressArray
 from log import Logger
 log = Logger('req')
 log.setLevel(0)
 
 
 VERSION = 0x01
-header_length = 85
+header_length = 89
 sig_length = 72
+sig_end = 13 + sig_length
 
 
 class MessageTypes(object):
     """ CoinParty messages """
     HELO = 0x00  # Introduce new input user's data
     ADDR = 0x01  # Announce shuffled and decrypted output addresses
+    ADR2 = 0x02  # Same as ADDR, but allows for large arrays
     ACKN = 0x0F  # Acknowledgement (hopefully can be designed out?)
     """ SMPC messages """
     MPCS = 0x10  # Secret value singlecast
@@ -55,6 +60,8 @@ class MessageTypes(object):
             return 'helo'
         elif (msg_type == MessageTypes.ADDR):
             return 'addr'
+        elif (msg_type == MessageTypes.ADR2):
+            return 'adr2'
         elif (msg_type == MessageTypes.ACKN):
             return 'ackn'
         elif (msg_type == MessageTypes.MPCS):
@@ -87,9 +94,11 @@ class MessageHandler(object):
         Bytes 3,4:   Sender rank
         Bytes 5-8:   Sequence Number
         Bytes 9-12:  Packet length
-        Bytes 13-82: ECDSA Signature """
-    _msg = struct('>BBHII73s')
+        Bytes 13-85: ECDSA Signature
+        Bytes 86-89: Mixing round """
+    _msg = struct('>BBHII73sI')
     _msg_length = struct('>I')
+    _msg_round = struct('>I')
 
     @staticmethod
     def checkResponse(msg):
@@ -128,7 +137,8 @@ class MessageHandler(object):
             rank,
             seq,
             0,
-            chr(0x00) * (sig_length + 1)  # Leave signature empty, must be filled in later
+            chr(0x00) * (sig_length + 1),  # Leave signature empty, must be filled in later
+            0  # Round is set when finalizing
         )
 
     @staticmethod
@@ -138,7 +148,8 @@ class MessageHandler(object):
             'msg': MessageTypes.getString(unpacked[1]),
             'rank': unpacked[2],
             'seq': unpacked[3],
-            'sig': unpacked[5]
+            'sig': unpacked[5],
+            'round': unpacked[6]
         }
 
     @staticmethod
@@ -157,6 +168,14 @@ class MessageHandler(object):
     def getSequenceNumber(msg):
         return struct('>I').unpack(msg[4:8])[0]
 
+    @staticmethod
+    def setRound(msg, round):
+        return msg[:sig_end] + MessageHandler._msg_round.pack(round) + msg[header_length:]
+
+    @staticmethod
+    def getRound(msg):
+        return MessageHandler._msg_round.unpack(msg[sig_end:header_length])[0]
+
     @staticmethod
     def getMessageType(msg):
         return struct('>B').unpack(msg[1])[0]
@@ -181,7 +200,7 @@ class MessageHandler(object):
         sig = crypter.sign(msg)
         length = len(sig)
         sig = struct('>B').pack(len(sig)) + sig + (chr(0x00) * (sig_length - length))
-        msg = msg[:12] + sig + msg[header_length:]
+        msg = msg[:12] + sig + msg[sig_end:]
         return msg
 
     @staticmethod
@@ -190,13 +209,16 @@ class MessageHandler(object):
             return False
         length = struct('>B').unpack(msg[12])[0]
         sig = msg[13:(13 + length)]
-        signstr = msg[:12] + (chr(0x00) * (sig_length + 1)) + msg[header_length:]
+        signstr = msg[:12] + (chr(0x00) * (sig_length + 1)) + msg[sig_end:]
         result = crypter.verify(sig, signstr)
         return result
 
     @staticmethod
     def finalizeRequest(msg, crypter):
+        """ Messages are stamped with the mixing round of the crypter they
+            are signed with, so the round is covered by the signature. """
         msg = MessageHandler.setLength(msg)
+        msg = MessageHandler.setRound(msg, crypter.getRound())
         msg = MessageHandler.signRequest(msg, crypter)
         return msg
 
@@ -306,42 +328,49 @@ class ackn(MessageHandler):
 
 #####################################################################
 #
-#       ADDR Message Handler @unused
+#       ADDR Message Handler
 #
 #####################################################################
 
 
 class addr(MessageHandler):
 
-    """ Structure of the addr message.
-        Byte 1-4:   Length of each list entry
-        Bytes 5-6:  Number of list entries
-        Bytes 6-oo: The array of addresses """
-    _msg = struct('>H')
+    """ Structure of the addr message. The array of addresses is sent in
+        chunks, each of which is an addr message of its own.
+        Bytes 1-2:  Index of this chunk
+        Bytes 3-4:  Number of chunks
+        Bytes 5-6:  Number of list entries in this chunk
+        Bytes 7-oo: The array of addresses, each prefixed by its length (4 bytes) """
+    _msg = struct('>HHH')
     _msg_addr = struct('>I')
 
     @staticmethod
-    def encode(rank, seq, crypter, addresses):
+    def encode(rank, seq, crypter, addresses, chunk=0, chunks=1):
         header = MessageHandler.encodeHeader(rank, seq, MessageTypes.ADDR)
         payload = addr._msg.pack(
+            chunk,
+            chunks,
             len(addresses)
         )
-        payload += reduce(lambda x, y: x + y, map(lambda x: addr._msg_addr.pack(len(x)) + x, addresses))
+        payload += ''.join([addr._msg_addr.pack(len(x)) + x for x in addresses])
         msg = header + payload
         return MessageHandler.finalizeRequest(msg, crypter)
 
     @staticmethod
     def decode(msg):
         result = MessageHandler.decodeHeader(msg[:header_length])
-        number_addresses = addr._msg.unpack(msg[header_length:(header_length + 2)])[0]
-        outputs = []
-        offset = header_length + 2
+        (chunk, chunks, number_addresses) = addr._msg.unpack(msg[header_length:(header_length + 6)])
+        outputs = AddressArray()
+        view = memoryview(msg)
+        offset = header_length + 6
         for i in xrange(number_addresses):
-            length = addr._msg_addr.unpack(msg[offset:(offset + 4)])[0]
+            length = addr._msg_addr.unpack_from(msg, offset)[0]
             offset += 4
-            outputs.append(msg[offset: (offset + length)])
+            outputs.append(view[offset:(offset + length)])
             offset += length
         result.update({
+            'chunk': chunk,
+            'chunks': chunks,
             'outputs': outputs
         })
         return result
@@ -352,10 +381,68 @@ class addr(MessageHandler):
         errors = super(addr, addr).checkResponse(msg)
         if ('outputs' not in msg.keys()):
             errors.append('outputs_missing')
-        if (len(errors) > 0 or len(msg['outputs']) < state.input.getNumberInputPeers()):
+        if ('chunk' not in msg.keys() or 'chunks' not in msg.keys() or msg['chunk'] >= msg['chunks']):
+            errors.append('chunk_invalid')
+        if (len(errors) > 0):
             log.critical('addr error occurred, but I\'m not handling it.')
             return None
-        state.shuffle.receivedAddrBroadcast(msg['outputs'], msg['rank'])
+        addresses = state.shuffle.receivedAddrChunk(msg['outputs'], msg['rank'], msg['chunk'], msg['chunks'])
+        if (addresses is None):
+            return None  # Further chunks are pending
+        if (len(addresses) < state.input.getNumberInputPeers()):
+            log.critical('addr error occurred, but I\'m not handling it.')
+            return None
+        state.shuffle.receivedAddrBroadcast(addresses, msg['rank'])
+
+
+class adr2(addr):
+
+    """ Structure of the adr2 message. The length table and the data are
+        each copied as a whole, so encoding and decoding take linear time.
+        Bytes 1-4:   Index of this chunk
+        Bytes 5-8:   Number of chunks
+        Bytes 9-12:  Number of list entries n in this chunk
+        Bytes 13-oo: Length of each entry (4 bytes each, n entries),
+                     followed by the concatenation of all entries """
+    _msg = struct('>III')
+
+    @staticmethod
+    def _bigEndian(lengths):
+        if (byteorder == 'little'):
+            lengths.byteswap()
+        return lengths
+
+    @staticmethod
+    def encode(rank, seq, crypter, addresses, chunk=0, chunks=1):
+        if (not isinstance(addresses, AddressArray)):
+            addresses = AddressArray(addresses)
+        header = MessageHandler.encodeHeader(rank, seq, MessageTypes.ADR2)
+        payload = adr2._msg.pack(
+            chunk,
+            chunks,
+            len(addresses)
+        )
+        lengths = adr2._bigEndian(array('I', addresses.getLengths()))
+        msg = ''.join([header, payload, lengths.tostring(), addresses.getBuffer().tobytes()])
+        return MessageHandler.finalizeRequest(msg, crypter)
+
+    @staticmethod
+    def decode(msg):
+        result = MessageHandler.decodeHeader(msg[:header_length])
+        (chunk, chunks, number_addresses) = adr2._msg.unpack_from(msg, header_length)
+        offset = header_length + adr2._msg.size
+        lengths = array('I')
+        lengths.fromstring(msg[offset:(offset + 4 * number_addresses)])
+        if (len(lengths) != number_addresses):
+            raise ValueError('address_table_too_short')
+        offset += 4 * number_addresses
+        outputs = AddressArray.fromBuffer(memoryview(msg)[offset:], adr2._bigEndian(lengths))
+        result.update({
+            'chunk': chunk,
+            'chunks': chunks,
+            'outputs': outputs
+        })
+        return result
 
 
 #####################################################################
@@ -380,6 +467,7 @@ class SmpcMessageHandler(MessageHandler):
     MUL = 0x03  # Multiplication protocol
     DKG = 0x04  # Distributed Key Generation protocol
     JDKG = 0x05  # JfDkg for generation of H as needed for DKG
+    VREC = 0x06  # Recombination protocol for vectors of shares
 
     @staticmethod
     def getAlgorithm(alg):
@@ -391,6 +479,8 @@ class SmpcMessageHandler(MessageHandler):
             return 'mul'
         elif (alg == SmpcMessageHandler.REC):
             return 'rec'
+        elif (alg == SmpcMessageHandler.VREC):
+            return 'vrec'
         elif (alg == SmpcMessageHandler.WRAP):
             return 'wrap'
         elif (alg == SmpcMessageHandler.CMUL):
@@ -408,6 +498,8 @@ class SmpcMessageHandler(MessageHandler):
             return SmpcMessageHandler.MUL
         elif (alg_str == 'rec'):
             return SmpcMessageHandler.REC
+        elif (alg_str == 'vrec'):
+            return SmpcMessageHandler.VREC
         elif (alg_str == 'wrap'):
             return SmpcMessageHandler.WRAP
         elif (alg_str == 'cmul'):
@@ -1007,8 +1099,8 @@ class rbrc(MessageHandler):
 #
 #####################################################################
 
-__message_handlers = [helo, ackn, addr, mpcs, mpcp, comp, cmpr, ncmp, cbrc, rbrc]
-__message_types = [MessageTypes.HELO, MessageTypes.ACKN, MessageTypes.ADDR,
+__message_handlers = [helo, ackn, addr, adr2, mpcs, mpcp, comp, cmpr, ncmp, cbrc, rbrc]
+__message_types = [MessageTypes.HELO, MessageTypes.ACKN, MessageTypes.ADDR, MessageTypes.ADR2,
                    MessageTypes.MPCS, MessageTypes.MPCP, MessageTypes.COMP,
                    MessageTypes.CMPR, MessageTypes.NCMP,
                    MessageTypes.CBRC, MessageTypes.RBRC]
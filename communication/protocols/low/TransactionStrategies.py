@@ -19,8 +19,9 @@
     You should have received a copy of the GNU General Public License
     along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
 
-from copy import copy
+from bisect import bisect_left
 from decimal import Decimal
+import heapq
 
 from log import Logger
 log = Logger('split')
@@ -37,11 +38,46 @@ split_values = [1000, 200, 100, 10, 1]  # Sorted decreasingly
 split_likely = [0.13, 0.19, 0.11, 0.45, 0.12]
 
 
+def _cumulative_distributions(values, likely):
+    """ For each j, return the cumulative distribution of choosing among
+        values[j:], i.e., once all larger values have been excluded. The
+        probabilities are renormalized and summed up exactly in the order
+        the splitting did it step by step, so that results do not change. """
+    distributions = []
+    sl = list(likely)
+    for j in xrange(0, len(values)):
+        if (j > 0):
+            l = sl[0]
+            del sl[0]
+            for i in xrange(0, len(sl)):
+                sl[i] = sl[i] / (1.0 - l)
+        cumulative = []
+        s = 0.0
+        for i in xrange(0, len(sl)):
+            s = sl[i] if (i == 0) else s + sl[i]
+            cumulative.append(s)
+        distributions.append(cumulative)
+    return distributions
+
+split_distributions = _cumulative_distributions(split_values, split_likely)
+
+
 def _is_integer(v):
     return v == v.to_integral_value()
 
 
-def _split_strategy_single_transaction(bitcoin_value, _):  # Do not use prng variable
+def _minimum_parts(value):
+    """ Minimum number of standard values summing up to value. Each value
+        divides all larger ones, hence taking the largest fitting value
+        first is optimal. """
+    parts = 0
+    for v in split_values:
+        parts += value // v
+        value %= v
+    return parts
+
+
+def _split_strategy_single_transaction(bitcoin_value, _, max_parts=1):  # Do not use prng variable
     test_val = 1000 * bitcoin_value
     if (not (_is_integer(test_val) and test_val in split_values)):
         log.critical('Detected disallowed Bitcoin value!')
@@ -50,53 +86,48 @@ def _split_strategy_single_transaction(bitcoin_value, _):  # Do not use prng var
     return [bitcoin_value]
 
 
-def _split_strategy_divide_and_fill(bitcoin_value, prng):
+def _split_strategy_divide_and_fill(bitcoin_value, prng, max_parts=None):
+    """ Split the value randomly into standard values. If max_parts is
+        given, only values that leave a remainder fitting into the parts
+        left are chosen among, and once the remainder needs all of them,
+        it is filled greedily. Every part is a standard value either way,
+        so that payouts stay indistinguishable. """
     split = []
-    remaining = copy(bitcoin_value)
-
-    sv = copy(split_values)
-    sl = copy(split_likely)
-    remaining = 1000 * remaining
+    remaining = 1000 * bitcoin_value
 
     # Check that number can be split (i.e. smallest split amount divides the value)
-    if (not _is_integer(remaining / Decimal(sv[-1]))):  # 1.0 needed as int has no method is_integer
+    if (not _is_integer(remaining / Decimal(split_values[-1]))):
         raise ValueError('value_not_splittable')  # TODO: Perform check during bootstrapping
 
     remaining = int(remaining)
+    if (max_parts is not None and _minimum_parts(remaining) > max_parts):
+        raise ValueError('value_not_splittable')
 
+    j = 0  # Index of the largest value that is not excluded
     while (remaining > 0):
-        while (len(sv) > 0 and remaining < sv[0]):  # Exclude too large values
-            log.debug('Remaining: ' + str(remaining) + ' => Removing value ' + str(sv[0]))
-            l = sl[0]
-            del sv[0]
-            del sl[0]
-            for i in xrange(0, len(sv)):
-                sl[i] = sl[i] / (1.0 - l)
-        r = randomfloat(prng)
-        s = sl[0]
-        i = 0
-        while (r > s):
-            log.debug('rem: ' + str(remaining) + '; i: ' + str(i) + '; r: ' + str(r) + '; s: ' + str(s))
-            try:
-                i += 1
-                s += sl[i]
-            except:
-                log.error('Error: ' + str(sl))
-                break
-        split.append(sv[i])
-        remaining -= sv[i]
-
-    probs = []
-    for i in xrange(0, len(split_values)):
-        probs.append(((1.0 * len(filter(lambda x: x == split_values[i], split))) / len(split), split_likely[i]))
-    split = map(lambda x: x / 1000.0, split)
-    log.debug('Split before shuffling:\n' + str(split))
+        while (j < len(split_values) and remaining < split_values[j]):  # Exclude too large values
+            j += 1
+        # Only choose among values whose remainder fits into the parts left
+        allowed = range(j, len(split_values))
+        if (max_parts is not None):
+            parts_left = max_parts - len(split) - 1
+            allowed = [k for k in allowed if (_minimum_parts(remaining - split_values[k]) <= parts_left)]
+        if (len(allowed) == len(split_values) - j):
+            cumulative = split_distributions[j]
+            k = j + min(bisect_left(cumulative, randomfloat(prng)), len(cumulative) - 1)
+        elif (len(allowed) == 1):
+            k = allowed[0]  # Greedy fill, nothing else fits anymore
+        else:
+            r = randomfloat(prng) * sum(split_likely[k] for k in allowed)
+            for k in allowed:
+                if (r <= split_likely[k]):
+                    break
+                r -= split_likely[k]
+        split.append(split_values[k])
+        remaining -= split_values[k]
+
+    split = [x / 1000.0 for x in split]
     prng.shuffle(split)
-    log.debug('Split after shuffling:\n' + str(split))
-
-    log.debug('Probability distributions:\n' + str(probs))
-    log.debug('Probability derivation:\n' + str([x[0] - x[1] for x in probs]))
-    log.debug('Split sum: ' + str(sum(split)))
     return split
 
 """ Strategies for obtaining a streaming schedule for one input peer """
@@ -119,5 +150,35 @@ def _schedule_strategy_random(split_length, mixing_window_mins, prng):
     schedule.sort()  # We need a monotonically increasing list, otherwise break transaction creation
     return schedule
 
-splitMixingAmount = _split_strategy_single_transaction
+
+def splitMixingAmount(bitcoin_value, prng, max_parts=1):
+    """ Each part requires its own output transaction and thus its own nonce.
+        Hence, the amount is only split if several nonces are available. """
+    if (max_parts > 1):
+        return _split_strategy_divide_and_fill(bitcoin_value, prng, max_parts)
+    return _split_strategy_single_transaction(bitcoin_value, prng)
+
+
 defineStreamingSchedule = _schedule_strategy_random
+
+
+def planPayouts(number_peers, bitcoin_value, mixing_window_mins, prng, max_parts=1):
+    """ Split the amount of each input peer and define its streaming
+        schedule, in the order of the input peers as the prng is shared.
+        Return the splits, the schedules and all payouts as tuples
+        (release time, input peer, part), ordered by release time. As each
+        schedule is sorted already, they only need to be merged. Ties are
+        broken by the order of input peers, so that all mixing peers
+        obtain the same order. """
+    splits = []
+    schedules = []
+    for _ in xrange(0, number_peers):
+        split = splitMixingAmount(bitcoin_value, prng, max_parts)
+        splits.append(split)
+        schedules.append(defineStreamingSchedule(len(split), mixing_window_mins, prng))
+    payouts = list(heapq.merge(*[
+        [(release_time, peer, part) for (part, release_time) in enumerate(schedule)]
+        for (peer, schedule) in enumerate(schedules)
+    ]))
+    log.debug('Planned ' + str(len(payouts)) + ' payouts for ' + str(number_peers) + ' input peers.')
+    return (splits, schedules, payouts)
@@ -34,6 +34,7 @@ class ActiveSmpcValueWithPublicValue(ActiveSmpcValue):
         super(ActiveSmpcValueWithPublicValue, self).__init__(id, index, state)
         self._public_value_deferred = Deferred()
         self._public_value = None
+        self._public_value_failure = None
         self._public_value_dependents = []
 
     def __statelen__(self):
@@ -59,9 +60,20 @@ class ActiveSmpcValueWithPublicValue(ActiveSmpcValue):
             d.callback(self._public_value)
         return self._public_value
 
+    def failDependentPublicDeferreds(self, failure):
+        """ The public value cannot be obtained. Let all current and future
+            dependents fail. """
+        self._public_value_failure = failure
+        while len(self._public_value_dependents) > 0:
+            d = self._public_value_dependents.pop()
+            d.errback(failure)
+        return None
+
     def getPublicValue(self):  # Uses same idea for "cloning" a deferred as viff.util.clone_deferred; but later
         deferred = Deferred()
-        if (self._public_value is None):
+        if (self._public_value_failure is not None):
+            deferred.errback(self._public_value_failure)
+        elif (self._public_value is None):
             self._public_value_dependents.append(deferred)
         else:
             deferred.callback(self._public_value)
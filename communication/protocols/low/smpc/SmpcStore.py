@@ -21,6 +21,7 @@
 
 from MultiplicationSmpcValue import MultiplicationSmpcValue
 from RecombinationSmpcValue import RecombinationSmpcValue
+from VectorRecombinationSmpcValue import VectorRecombinationSmpcValue
 from JfDkgSmpcValue import JfDkgSmpcValue
 from NewDkgSmpcValue import NewDkgSmpcValue
 from WrapperSmpcValue import WrapperSmpcValue
@@ -98,6 +99,9 @@ class SmpcStore(object):
         elif (algorithm_name == 'rec'):
             classname = RecombinationSmpcValue
             is_active = True
+        elif (algorithm_name == 'vrec'):
+            classname = VectorRecombinationSmpcValue
+            is_active = True
         elif (algorithm_name == 'wrap'):
             classname = WrapperSmpcValue
             is_active = False
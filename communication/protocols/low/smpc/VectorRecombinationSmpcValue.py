@@ -0,0 +1,145 @@
+""" CoinParty - Vector Recombination SMPC Value
+    An implementation of the recombination of many secret shares at once
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from math import ceil, log
+
+from twisted.internet.defer import DeferredList, FirstError, maybeDeferred
+
+from .. import Requests as req
+from ..constants import bitcoin_order as standard_order
+from shamir import recombine
+from RecombinationSmpcValue import RecombinationSmpcValue
+from ..Transaction import BroadcastTransaction
+
+
+class VectorRecombinationSmpcValue(RecombinationSmpcValue):
+    """ Decoupled recombination of a whole vector of secret shares.
+        The shares are concatenated with a fixed length each and sent within
+        a single public value broadcast. Each element is then recombined on
+        its own, so that malformed shares only affect the element they
+        belong to. The public value is the list of recombined elements. """
+
+    """ The length of public values is encoded in two bytes (see mpcp).
+        With 32 bytes per share, up to 2047 shares fit into one vector. """
+    _max_payload = 0xFFFF
+
+    def __init__(self, id, index, state):
+        super(VectorRecombinationSmpcValue, self).__init__(id, index, state)
+
+    @staticmethod
+    def getAlgorithm():
+        return 'vrec'
+
+    @staticmethod
+    def getShareLength(order=standard_order):
+        return int(ceil(log(order) / (8.0 * log(2))))
+
+    @staticmethod
+    def getMaximumLength(order=standard_order):
+        return VectorRecombinationSmpcValue._max_payload // VectorRecombinationSmpcValue.getShareLength(order)
+
+    def initialize(self, smpc_values, order=standard_order):
+        def _collect_secret_shares(shares):
+            self._secret_share = [s[1] for s in shares]
+            self.informDependentSecretDeferreds()
+            return self._secret_share
+
+        def _wait_for_values(_):
+            return self._public_value_deferred
+
+        def _share_failed(failure):
+            """ Do not distribute anything if an element's share could not
+                be obtained, but let dependents of the vector fail as well. """
+            failure = failure.value.subFailure if (isinstance(failure.value, FirstError)) else failure
+            if (not self._public_value_deferred.called):
+                self._public_value_deferred.errback(failure)
+            return failure
+
+        def _inform_dependent_public_deferreds(value):
+            self.informDependentPublicDeferreds()
+            return value
+
+        if (len(smpc_values) > self.getMaximumLength(order)):
+            raise ValueError('vector_too_long')
+
+        self._order = order
+        shares = DeferredList([maybeDeferred(v.getSecretShare) for v in smpc_values], fireOnOneErrback=True, consumeErrors=True)
+        shares.addCallbacks(_collect_secret_shares, _share_failed)
+        shares.addCallback(self.distributeShares)
+        shares.addCallback(_wait_for_values)
+        self._public_value_deferred.addCallback(self.computePublicValue)
+        self._public_value_deferred.addCallback(_inform_dependent_public_deferreds)
+        self._public_value_deferred.addErrback(self.failDependentPublicDeferreds)
+        return shares
+
+    def sendPublicValues(self):
+        connected_peers = self._getConnectedPeers()
+        seq = self._transactions.getNextSequenceNumber()
+        length = self.getShareLength(self._order)
+        binary_shares = ''.join(['{0:0{1}x}'.format(share, 2 * length).decode('hex') for share in self._secret_share])
+        msg = req.mpcp.encode(
+            self._rank,
+            seq,
+            self._crypters[self._rank],
+            self.getAlgorithm(),
+            self.getID(),
+            self.getIndex(),
+            binary_shares
+        )
+        share_deferred = self._transactions.addTransaction(
+            BroadcastTransaction(
+                self._rank,
+                connected_peers,
+                msg,
+                seq,
+                None
+            )
+        )
+        self.receivedPublicValue(self._rank, binary_shares)
+        return share_deferred
+
+    def receivedPublicValue(self, peer_rank, binary_value):
+        """ Shares may arrive before initialize sets the order, which defines
+            the length of each share. Thus, they are kept in binary until the
+            public value is computed. """
+        if (self._public_value_deferred.called or self._received_shares[peer_rank] is not None):  # Ignore late/unexpected shares
+            return
+        self._received_shares[peer_rank] = binary_value
+        if (len(filter(lambda c: c is None, self._received_shares)) == 0):
+            self._public_value_deferred.callback(None)
+        return
+
+    def _parseShares(self, binary_value, size):
+        """ Split a received vector of binary shares, or return None if it
+            does not hold size shares of the value's order. """
+        length = self.getShareLength(self._order)
+        if (binary_value is None or len(binary_value) != size * length):
+            return None
+        return [int(binary_value[i:(i + length)].encode('hex'), 16) for i in xrange(0, size * length, length)]
+
+    def computePublicValue(self, _):
+        # The length of the vector is defined by our own shares
+        size = len(self._secret_share)
+        received = [self._parseShares(s, size) for s in self._received_shares]
+        self._public_value = []
+        for j in xrange(0, size):
+            shares = [(i + 1, None if received[i] is None else received[i][j]) for i in xrange(0, self._n)]
+            self._public_value.append(recombine(shares, self._t, order=self._order))
+        return self._public_value
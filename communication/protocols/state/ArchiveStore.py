@@ -0,0 +1,84 @@
+""" CoinParty - Archive Store
+    On-disk store of the records of concluded mixing rounds.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+import sqlite3
+import json
+
+
+def _toStr(value):
+    """ json.loads returns unicode strings, whereas the state (and Twisted's
+        request.write) uses byte strings, which json.dumps took as UTF-8. """
+    if (isinstance(value, unicode)):
+        return value.encode('utf-8')
+    if (isinstance(value, list)):
+        return [_toStr(v) for v in value]
+    if (isinstance(value, dict)):
+        return dict((_toStr(k), _toStr(v)) for (k, v) in value.iteritems())
+    return value
+
+
+class ArchiveStore(object):
+    """ Keep round records (see compactState) in an SQLite database, indexed
+        by the session IDs of their input peers. Records are stored as JSON.
+        The path ':memory:' keeps the database in memory, which still holds
+        the compact records only. """
+
+    def __init__(self, path=':memory:'):
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS rounds ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'mixnet_id TEXT NOT NULL, '
+            'round INTEGER NOT NULL, '
+            'record TEXT NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'session_id TEXT PRIMARY KEY, '
+            'round_id INTEGER NOT NULL REFERENCES rounds(id))'
+        )
+        self._db.commit()
+
+    def store(self, record):
+        """ Store a round record and return its key. """
+        cursor = self._db.execute(
+            'INSERT INTO rounds (mixnet_id, round, record) VALUES (?, ?, ?)',
+            (record['mixnet_id'], record['round'], json.dumps(record))
+        )
+        key = cursor.lastrowid
+        self._db.executemany(
+            'INSERT OR REPLACE INTO sessions (session_id, round_id) VALUES (?, ?)',
+            [(input_peer['session_id'], key) for input_peer in record['input_peers']]
+        )
+        self._db.commit()
+        return key
+
+    def load(self, key):
+        row = self._db.execute('SELECT record FROM rounds WHERE id = ?', (key,)).fetchone()
+        return None if (row is None) else _toStr(json.loads(row[0]))
+
+    def findSession(self, session_id):
+        """ Return the key of the round record containing the session, or
+            None if there is none. """
+        row = self._db.execute('SELECT round_id FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return None if (row is None) else row[0]
+
+    def close(self):
+        self._db.close()
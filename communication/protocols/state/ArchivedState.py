@@ -0,0 +1,124 @@
+""" CoinParty - Archived State
+    Compact record of a concluded mixing round, sufficient for input peers to
+    review their participation.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+from twisted.internet.defer import succeed
+from decimal import Decimal
+
+
+def compactState(state):
+    """ Compact a concluded BaseState into a record of plain values (see
+        ArchivedState). Only input peers that joined the round and revealed
+        their secret are kept; others could never verify their session, so
+        looking them up yields no input peer, i.e., a clean negative ack. """
+    return {
+        'mixnet_id'        : state.mixnet.getMixnetID(),
+        'round'            : state.getRound(),
+        'threshold'        : state.mixnet.getMixpeerThreshold(),
+        'peers'            : [[peer['id'], peer['web']] for peer in state.mixnet.getMixpeers()],
+        'bitcoin_value'    : str(state.getBitcoinValue()),
+        'commitment_value' : str(state.getCommitmentValue()),
+        'input_peers'      : [{
+            'id'           : input_peer['id'],
+            'session_id'   : input_peer['session_id'],
+            'address'      : input_peer['address'],
+            'txid'         : input_peer['txid'],
+            'tx_confirmed' : input_peer['tx_confirmed'],
+            'used_secret'  : input_peer['used_secret'],
+            'report'       : list(input_peer['report'])
+        } for input_peer in state.input.getAssignedEscrows() if (input_peer['session_id'] is not None and input_peer['used_secret'] is not None)]
+    }
+
+
+class ArchivedState(object):
+    """ Read-only stand-in for the BaseState of a concluded round, offering
+        what the web interface needs to let input peers verify their
+        participation. It is built from a record of compactState. """
+
+    class ArchivedMixnet(object):
+
+        def __init__(self, record):
+            self._mixnet_id = record['mixnet_id']
+            self._threshold = record['threshold']
+            self._peers = [{'id' : id, 'web' : web, 'rank' : rank} for (rank, (id, web)) in enumerate(record['peers'])]
+
+        def getMixnetID(self):
+            return self._mixnet_id
+
+        def getMixnetSize(self):
+            return len(self._peers)
+
+        def getMixpeerThreshold(self):
+            return self._threshold
+
+        def getMixpeers(self):
+            return self._peers
+
+    class ArchivedInputPeers(object):
+
+        def __init__(self, record):
+            self._sessions = dict((input_peer['session_id'], input_peer) for input_peer in record['input_peers'])
+
+        def getSessionIDs(self):
+            return self._sessions.keys()
+
+        def getInputPeer(self, key, value):
+            # Archived input peers are only looked up by their session
+            input_peer = self._sessions.get(value, None) if (key == 'session_id') else None
+            if (input_peer is None):
+                return None
+            # The secret was used long ago, hence it is readily available
+            input_peer = dict(input_peer)
+            input_peer['secret_deferred'] = succeed(input_peer['used_secret'])
+            return input_peer
+
+    class ArchivedCommitment(object):
+
+        def getRemainingTime(self):
+            return 0
+
+    def __init__(self, record):
+        self._round = record['round']
+        self._bitcoin_value = Decimal(record['bitcoin_value'])
+        self._commitment_value = Decimal(record['commitment_value'])
+        self.mixnet = ArchivedState.ArchivedMixnet(record)
+        self.input = ArchivedState.ArchivedInputPeers(record)
+        self.commit = ArchivedState.ArchivedCommitment()
+
+    def getRound(self):
+        return self._round
+
+    def isArchived(self):
+        return True
+
+    def getBitcoinValue(self):
+        return self._bitcoin_value
+
+    def getCommitmentValue(self):
+        return self._commitment_value
+
+    def allPaymentsReceived(self):
+        return True
+
+    def isInStreamingPhase(self):
+        return False
+
+    def isMixingConcluded(self):
+        return True
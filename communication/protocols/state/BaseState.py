@@ -24,12 +24,19 @@ from InputPeerState import InputPeerState
 from CommitmentState import CommitmentState
 from CryptoState import CryptoState
 from MixnetState import MixnetState
+from SigningState import SigningState
+from RoundManager import RoundManager
+from ArchivedState import ArchivedState, compactState
+from ArchiveStore import ArchiveStore
 
 from ..low.smpc.SmpcStore import SmpcStore
+from ..low.PayoutScheduler import PayoutScheduler
 
 from twisted.internet.defer import Deferred
 from twisted.internet import reactor
 from ..low.Transaction import TransactionStore
+from collections import OrderedDict
+import os
 import re
 
 from decimal import Decimal, getcontext
@@ -41,24 +48,32 @@ class BaseState(object):
         different phases of the mixing. """
 
     """ Set up a mixing state and its sub-states. """
-    def __init__(self, rank, mixnet_id, mixnet_size, mixing_window_mins=0.5, clock=reactor):
+    def __init__(self, rank, mixnet_id, mixnet_size, mixing_window_mins=0.5, clock=reactor, nonces_per_escrow=1, batch_interval=0, fee_bump_blocks=0, open_checksums_early=False, round=0, concurrent_rounds=1, rounds=None):
         self._shutdown_flag = False
+        self._round = round
         self._error_deferred = Deferred()
+        self._outbound_deferred = None
         self.rank = rank
         self._bitcoin_value = Decimal(str(0.1)) + Decimal('0.00000000')
         self._mixing_window_mins = mixing_window_mins
+        self._batch_interval = batch_interval
+        self._fee_bump_blocks = fee_bump_blocks
+        self._open_checksums_early = open_checksums_early
         self._clock = clock
 
         self.mixnet = MixnetState(mixnet_id, mixnet_size, rank)
-        self.input = InputPeerState(rank, mixnet_size)
+        self.input = InputPeerState(rank, mixnet_size, session_listener=self._indexSession)
         self.commit = CommitmentState()
         self.shuffle = ShufflingState(mixnet_size)
-        self.crypto = CryptoState()
+        self.crypto = CryptoState(round)
+        self.signing = SigningState(nonces_per_escrow)
 
         self.smpc = SmpcStore()
+        self.payouts = PayoutScheduler(clock)
 
         self._in_streaming_phase = False
         self._mixing_concluded = False
+        self._archived = False
 
         self._last_block = None
         self._p2p_client = None
@@ -68,6 +83,31 @@ class BaseState(object):
         self.transactions = TransactionStore()
         self.dummy_deferred = Deferred()
 
+        self.rounds = RoundManager(self, concurrent_rounds) if (rounds is None) else rounds
+
+    def renew(self, round):
+        """ Create the state of another mixing round of this mixnet. It
+            shares the mixnet, i.e., the keys and peer connections, with this
+            state; all other sub-states start out empty. """
+        state = BaseState(
+            self.rank,
+            self.mixnet.getMixnetID(),
+            self.mixnet.getMixnetSize(),
+            mixing_window_mins=self._mixing_window_mins,
+            clock=self._clock,
+            nonces_per_escrow=self.signing.getNoncesPerEscrow(),
+            batch_interval=self.getBatchInterval(),
+            fee_bump_blocks=self.getFeeBumpBlocks(),
+            open_checksums_early=self.opensChecksumsEarly(),
+            round=round,
+            rounds=self.rounds
+        )
+        state.mixnet = self.mixnet
+        state.crypto = self.crypto.renew(round)
+        state.setP2pServer(self._p2p_server, self._p2p_server_deferred)
+        state.setP2pClient(self._p2p_client, self._p2p_client_deferred)
+        return state
+
     @staticmethod
     def getTransactionFee():
         return Decimal("0.0001")
@@ -75,6 +115,12 @@ class BaseState(object):
     def getClock(self):
         return self._clock
 
+    def getRound(self):
+        return self._round
+
+    def _indexSession(self, session_id):
+        mstate.indexSession(session_id, self)
+
     def enterStreamingPhase(self):
         self._in_streaming_phase = True
 
@@ -88,9 +134,35 @@ class BaseState(object):
     def isMixingConcluded(self):
         return self._mixing_concluded
 
+    def setArchived(self):
+        self._archived = True
+
+    def isArchived(self):
+        return self._archived
+
     def getBitcoinValue(self):
         return self._bitcoin_value
 
+    def getBatchInterval(self):
+        """ Length (in seconds) of the time buckets in which payouts are
+            aggregated into one transaction; 0 disables batching. """
+        return self._batch_interval
+
+    def getFeeBumpBlocks(self):
+        """ Number of blocks after which unconfirmed payouts are replaced by
+            ones paying a higher fee; 0 disables fee bumping. """
+        return self._fee_bump_blocks
+
+    def opensChecksumsEarly(self):
+        """ Whether the checksums of all shuffle layers are opened at once,
+            right after the escrows are frozen (see prepareChecksums). """
+        return self._open_checksums_early
+
+    def getCommitmentValue(self):
+        """ Input peers commit the mixed value plus the fees of all output
+            transactions, i.e., one per nonce of their escrow. """
+        return self._bitcoin_value + self.getTransactionFee() * self.signing.getNoncesPerEscrow()
+
 
 # Blocking of the web interface
 
@@ -126,28 +198,24 @@ class BaseState(object):
             raise KeyError('Last block hash is not known!')
 
     def getUnseenTransactionEscrows(self):
-        return self.input._unseen_tx_escrow_addresses
+        return self.input.getCommitmentTracker().getUnseenEscrows()
 
     def getUnconfirmedTransactions(self):
-        return self.input._unconfirmed_transactions
+        return self.input.getCommitmentTracker().getUnconfirmedTransactions()
 
-    def foundCommitment(self, txid):
+    def foundCommitment(self, txid, height=None):
         input_peer = self.input.getInputPeer('txid', txid)
         if (input_peer is None):
             raise ValueError('txid_not_found')
-        index = self.input._unconfirmed_transactions.index(txid)
-        del self.input._unconfirmed_transactions[index]
+        self.input.getCommitmentTracker().confirmed(txid)
         input_peer['tx_confirmed'] = True
+        input_peer['tx_height'] = height
         return
 
     def allPaymentsReceived(self):
         if (not self.input.inputPeersFrozen()):
             return False
-        result = True
-        for input_peer in self.input.getAssignedEscrows():
-            if (not input_peer['tx_confirmed']):
-                result = False
-        return result
+        return self.input.getCommitmentTracker().allConfirmed()
 
     def setP2pServer(self, p2p_server, p2p_server_deferred):
         self._p2p_server = p2p_server
@@ -179,14 +247,34 @@ class BaseState(object):
         if (not self._error_deferred.called):
             self._error_deferred.errback(exception)
 
+    def setOutboundDeferred(self, outbound_deferred):
+        """ Set the Deferred that fires once all output transactions whose
+            fee may be bumped are confirmed. """
+        self._outbound_deferred = outbound_deferred
+
+    def getOutboundDeferred(self):
+        return self._outbound_deferred
+
 
 class MixingPeerState():
 
     _using_testnet = True
+    _watch_addresses = False
+    _notification_endpoint = None
+    _nonces_per_escrow = 1
+    _batch_interval = 0
+    _fee_bump_blocks = 0
+    _open_checksums_early = False
+    _concurrent_rounds = 1
+    _history_size = 16
+    _decryption_workers = 0
+    _archive_dir = None
 
     def __init__(self, states=[]):
         self._array = states
-        self._history = []
+        self._history = OrderedDict()  # Archive key -> ArchivedState, least recently used first
+        self._archive = None
+        self._sessions = dict()  # Session ID -> state of a running round
         self._id = None
         self._pubkey = None
         self._prvkey = None
@@ -199,10 +287,40 @@ class MixingPeerState():
 
     def setGlobalConfig(self, global_config):
         self._using_testnet = global_config.as_bool('testnet')
+        if ('watch_addresses' in global_config):
+            self._watch_addresses = global_config.as_bool('watch_addresses')
+        if (global_config.get('zmq_endpoint', '') != ''):
+            self._notification_endpoint = global_config['zmq_endpoint']
+        if ('nonces_per_escrow' in global_config):
+            self._nonces_per_escrow = global_config.as_int('nonces_per_escrow')
+            if (self._nonces_per_escrow < 1):
+                raise ValueError('nonces_per_escrow must be positive')
+        if ('batch_interval' in global_config):
+            self._batch_interval = global_config.as_float('batch_interval')
+        if ('fee_bump_blocks' in global_config):
+            self._fee_bump_blocks = global_config.as_int('fee_bump_blocks')
+        if ('open_checksums_early' in global_config):
+            self._open_checksums_early = global_config.as_bool('open_checksums_early')
+        if ('concurrent_rounds' in global_config):
+            self._concurrent_rounds = global_config.as_int('concurrent_rounds')
+            if (self._concurrent_rounds < 1):
+                raise ValueError('concurrent_rounds must be positive')
+        if ('history_size' in global_config):
+            self._history_size = global_config.as_int('history_size')
+            if (self._history_size < 0):
+                raise ValueError('history_size must not be negative')
+        if ('decryption_workers' in global_config):
+            self._decryption_workers = global_config.as_int('decryption_workers')
+            if (self._decryption_workers < 0):
+                raise ValueError('decryption_workers must not be negative')
+        if (global_config.get('archive_dir', '') != ''):
+            self._archive_dir = global_config['archive_dir']
         return
 
     def getState(self, mixnet_id):
-        return next((state for state in self._array if (state.mixnet.getMixnetID() == mixnet_id)), None)
+        """ Return the newest round of a mixnet, i.e., the one input peers
+            may join. """
+        return next((state for state in reversed(self._array) if (state.mixnet.getMixnetID() == mixnet_id)), None)
 
     def findState(self, txid):
         return next((state for state in self._array if (state.input.getInputPeer('txid', txid) is not None)), None)
@@ -216,9 +334,59 @@ class MixingPeerState():
     def usingTestnet(self):
         return self._using_testnet
 
+    def watchingAddresses(self):
+        """ States whether escrow addresses are imported into bitcoind's
+            wallet to find commitment transactions. """
+        return self._watch_addresses
+
+    def getNotificationEndpoint(self):
+        """ Return the ZeroMQ endpoint of bitcoind's block and transaction
+            notifications, or None if none is configured. """
+        return self._notification_endpoint
+
+    def getNoncesPerEscrow(self):
+        """ Return the number of nonces precomputed per escrow, which is the
+            maximum number of output transactions per input peer. """
+        return self._nonces_per_escrow
+
+    def getBatchInterval(self):
+        return self._batch_interval
+
+    def getFeeBumpBlocks(self):
+        return self._fee_bump_blocks
+
+    def opensChecksumsEarly(self):
+        return self._open_checksums_early
+
+    def getConcurrentRounds(self):
+        """ Return the number of mixing rounds a mixnet runs overlapped. """
+        return self._concurrent_rounds
+
+    def getDecryptionWorkers(self):
+        """ Return the number of processes decrypting addresses; 0 means one
+            per CPU. """
+        return self._decryption_workers
+
+    def getHistorySize(self):
+        """ Return the number of archived rounds kept in memory. """
+        return self._history_size
+
+    def getArchive(self):
+        """ Return the store of archived rounds. It is kept in the archive
+            directory if one is configured, and in memory otherwise. """
+        if (self._archive is None):
+            if (self._archive_dir is None):
+                path = ':memory:'
+            else:
+                path = os.path.join(self._archive_dir, 'archive-' + str(self._id) + '.sqlite')
+            self._archive = ArchiveStore(path)
+        return self._archive
+
     def getFormattedMixnetList(self, format_good, format_bad):
         list = ''
         for state in self._array:
+            if (state is not self.getState(state.mixnet.getMixnetID())):
+                continue  # Only list the newest round of each mixnet
             line = re.sub('\#id\#', state.mixnet.getMixnetID(), format_good if (not state.webServerBlocked()) else format_bad)
             list += line
         return list
@@ -230,19 +398,41 @@ class MixingPeerState():
         self._array.append(state)
         return
 
+    def indexSession(self, session_id, state):
+        self._sessions[session_id] = state
+
     def findInputPeer(self, session_id):
-        """ Search for a session ID among all states.
-            This assumes that session IDs are "sufficiently unique". """
-        for state in self._array:
-            input_peer = state.input.getInputPeer('session_id', session_id)
-            if (input_peer is not None):
-                return {'input_peer' : input_peer, 'state' : state, 'history' : False}
-        for state in self._history:
+        """ Search for a session ID among all states, then among the
+            archived rounds. This assumes that session IDs are "sufficiently
+            unique". """
+        state = self._sessions.get(session_id, None)
+        if (state is None):
+            state = self._getArchivedState(session_id)
+        if (state is not None):
             input_peer = state.input.getInputPeer('session_id', session_id)
             if (input_peer is not None):
-                return {'input_peer' : input_peer, 'state' : state, 'history' : True}
+                return {'input_peer' : input_peer, 'state' : state, 'history' : state.isArchived()}
         return {'input_peer' : None, 'state' : None, 'history' : False}
 
+    def _getArchivedState(self, session_id):
+        if (self._archive is None):
+            return None
+        key = self._archive.findSession(session_id)
+        if (key is None):
+            return None
+        state = self._history.pop(key, None)
+        if (state is None):
+            state = ArchivedState(self._archive.load(key))
+        self._remember(key, state)
+        return state
+
+    def _remember(self, key, archived_state):
+        """ Keep an archived round in the in-memory history, evicting the
+            least recently used ones beyond the history size. """
+        self._history[key] = archived_state
+        while (len(self._history) > self._history_size):
+            self._history.popitem(last=False)
+
     def getFormattedVerifyList(self, format, cookies):
         list = ''
 
@@ -261,16 +451,27 @@ class MixingPeerState():
         return list
 
     def renewState(self, mixnet_id):
-        state = self.getState(mixnet_id)
-        new_state = BaseState(
-            state.mixnet.getRank(),
-            state.mixnet.getMixnetID(),
-            state.mixnet.getMixnetSize()
-        )
-        state_index = self._array.index(state)
-        del self._array[state_index]
+        """ Start the next mixing round of a mixnet, which must have been
+            requested from its round manager. The running rounds are kept. """
+        new_state = self.getState(mixnet_id).rounds.startRound()
         self.appendState(new_state)
-        self._history.append(state)
+        return new_state
+
+    def archiveState(self, state):
+        """ Compact a concluded round into a verification record and move
+            it to the archive, where input peers can still review it. The
+            state itself is dropped. Returns whether the next round can be
+            started now (see RoundManager.concludeRound). """
+        self.removeState(state)
+        state.setArchived()
+        record = compactState(state)
+        key = self.getArchive().store(record)
+        archived_state = ArchivedState(record)
+        for input_peer in state.input.getAssignedEscrows():
+            if (self._sessions.get(input_peer['session_id'], None) is state):
+                del self._sessions[input_peer['session_id']]
+        self._remember(key, archived_state)
+        return state.rounds.concludeRound(state, until=state.getOutboundDeferred())
 
     def setWebServer(self, webserver):
         self._webserver = webserver
@@ -45,6 +45,7 @@ class CommitmentState():
         self._polling_loopcall = None  # This is set using setPollingDeferred
         self._polling_loopcall_deferred = None  # Set together with the loopcall itself
         self._timeout_deferred = None  # Set by startPeerGathering
+        self._watcher = None  # Set by setCommitmentWatcher
 
     def increasePeerCount(self):
         self._number_peers += 1
@@ -95,6 +96,14 @@ class CommitmentState():
         del self._pending_nonces[index]
         return True
 
+    """ Watcher for commitment transactions """
+
+    def setCommitmentWatcher(self, watcher):
+        self._watcher = watcher
+
+    def getCommitmentWatcher(self):
+        return self._watcher
+
     """ Threshold deferred denoting sufficient number of input peers """
 
     def getThresholdDeferred(self):
@@ -111,6 +120,16 @@ class CommitmentState():
         self._polling_loopcall_deferred = d
         return d # For adding callbacks
 
+    def triggerPolling(self, *_):
+        """ Run the polling function right away instead of waiting for the
+            next period to elapse. Its regular schedule is left unchanged. """
+        if (self._polling_loopcall is None or not self._polling_loopcall.running):
+            return
+        call = self._polling_loopcall.call
+        if (call is not None and call.active()):
+            call.reset(0)
+        return
+
     def getPollingDeferred(self):
         return self._polling_loopcall_deferred
 
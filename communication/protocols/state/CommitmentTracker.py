@@ -0,0 +1,75 @@
+""" CoinParty - Commitment Tracker
+    Keeps track of the commitment transactions input peers still owe us.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+
+class CommitmentTracker(object):
+    """ Each escrow assigned to an input peer is unseen until a transaction
+        to it is found, after which the transaction is unconfirmed until it
+        is buried deep enough. Both are kept as hash sets, and counters tell
+        whether all commitments are confirmed without visiting the escrows.
+        The version changes whenever the set of unseen escrows does, so
+        that watchers only need to resynchronize on changes. """
+
+    def __init__(self):
+        self._unseen = set()  # Escrow addresses without a commitment yet
+        self._unconfirmed = set()  # txids of not yet confirmed commitments
+        self._number_expected = 0
+        self._number_confirmed = 0
+        self._version = 0
+
+    def expect(self, address):
+        """ An input peer was assigned the escrow address. """
+        if (address in self._unseen):
+            return
+        self._unseen.add(address)
+        self._number_expected += 1
+        self._version += 1
+
+    def seen(self, address, txid):
+        """ A commitment transaction to the escrow address was found. """
+        if (address not in self._unseen):
+            raise ValueError('escrow_not_unseen')
+        self._unseen.remove(address)
+        self._unconfirmed.add(txid)
+        self._version += 1
+
+    def confirmed(self, txid):
+        """ The commitment transaction has sufficiently many confirmations. """
+        if (txid not in self._unconfirmed):
+            raise ValueError('txid_not_unconfirmed')
+        self._unconfirmed.remove(txid)
+        self._number_confirmed += 1
+
+    def getUnseenEscrows(self):
+        """ Note: The returned set must not be modified. """
+        return self._unseen
+
+    def getUnconfirmedTransactions(self):
+        """ Note: The returned set must not be modified. """
+        return self._unconfirmed
+
+    def getNumberUnseen(self):
+        return len(self._unseen)
+
+    def getVersion(self):
+        return self._version
+
+    def allConfirmed(self):
+        return (self._number_confirmed == self._number_expected)
@@ -22,8 +22,28 @@
 import pyelliptic
 
 
+class RoundCrypter(object):
+    """ Our own crypter as used within one mixing round. Messages finalized
+        with it are stamped with the round; everything else is delegated to
+        the underlying ECC object. """
+
+    def __init__(self, crypter, round):
+        self._crypter = crypter
+        self._round = round
+
+    def __getattr__(self, name):
+        return getattr(self._crypter, name)
+
+    def getRound(self):
+        return self._round
+
+    def forRound(self, round):
+        return RoundCrypter(self._crypter, round)
+
+
 class CryptoState(object):
-    def __init__(self):
+    def __init__(self, round=0):
+        self._round = round
         self._prvkey = None
         self._pubkey = None
         self._crypter = None
@@ -35,13 +55,25 @@ class CryptoState(object):
             self._pubkey = public_key_hex
         except TypeError:
             raise TypeError('Could not decode keys.')
-        self._crypter = pyelliptic.ECC(
-            curve='secp256k1',
-            privkey=self._prvkey.decode('hex'),
-            pubkey=self._pubkey.decode('hex')
+        self._crypter = RoundCrypter(
+            pyelliptic.ECC(
+                curve='secp256k1',
+                privkey=self._prvkey.decode('hex'),
+                pubkey=self._pubkey.decode('hex')
+            ),
+            self._round
         )
         return
 
+    def renew(self, round):
+        """ Return the crypto state of another mixing round, sharing the
+            keys with this one. """
+        crypto = CryptoState(round)
+        crypto._prvkey = self._prvkey
+        crypto._pubkey = self._pubkey
+        crypto._crypter = self._crypter.forRound(round) if (self._crypter is not None) else None
+        return crypto
+
     def getPublicKey(self):
         return self._pubkey
 
@@ -20,20 +20,30 @@
     along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
 
 from twisted.internet.defer import Deferred
+from ..low.Bitcoin import computeScriptPubKey
+from ..low.AddressArray import AddressArray
+from CommitmentTracker import CommitmentTracker
 
 
 class InputPeerState():
     """ Define conditions for the range of accepted numbers of input peers. """
 
-    def __init__(self, rank, mixnet_size):
+    """ Keys of input peers that are looked up via hash indexes, i.e., they
+        must only be assigned through the setters below. """
+    INDEXED_KEYS = ('address', 'session_id', 'txid')
+
+    def __init__(self, rank, mixnet_size, session_listener=None):
 
         # Escrow address assignment
         self._rank = rank
         self._escrow_next_free_slot = self._rank
         self._mixnet_size = mixnet_size
         self._escrow_addresses = []
+        self._indexes = dict((key, dict()) for key in InputPeerState.INDEXED_KEYS)
+        self._session_listener = session_listener
         self._session_errors = []
-        self._encrypted_output_addresses = []
+        self._session_error_index = dict()
+        self._encrypted_output_addresses = AddressArray()
         self._partially_decrypted_addresses = []
         self._number_peers = 0
         self._input_peers_frozen = False
@@ -44,13 +54,16 @@ class InputPeerState():
 
         self._output_deferred = Deferred()
 
-        """ Ordered list of those escrow addresses that did not yet occur in a transaction. """
-        self._unseen_tx_escrow_addresses = []
-        self._unconfirmed_transactions = []
+        """ Escrows awaiting their commitment transaction and commitments
+            awaiting their confirmation. """
+        self._commitments = CommitmentTracker()
 
     def getFreezingDeferred(self):
         return self._freezing_deferred
 
+    def getCommitmentTracker(self):
+        return self._commitments
+
     def _getLowestFreeSlot(self):
         if (self._escrow_next_free_slot >= len(self._escrow_addresses)):
             return None
@@ -63,18 +76,39 @@ class InputPeerState():
         try:
             if (key == 'id'):
                 input_peer = self._escrow_addresses[value]
+            elif (key in self._indexes):
+                input_peer = self._indexes[key].get(value, None)
             else:
                 input_peer = next((i for i in self._escrow_addresses if i[key] == value), None)
         except:
             input_peer = None
         return input_peer
 
+    def _index(self, input_peer, key, value):
+        """ Set an indexed key of an input peer and keep its index in sync. """
+        old_value = input_peer[key]
+        if (old_value is not None and self._indexes[key].get(old_value, None) is input_peer):
+            del self._indexes[key][old_value]
+        input_peer[key] = value
+        if (value is not None):
+            self._indexes[key][value] = input_peer
+
+    def setSessionID(self, input_peer, session_id):
+        self._index(input_peer, 'session_id', session_id)
+        if (self._session_listener is not None and session_id is not None):
+            self._session_listener(session_id)
+
+    def setCommitment(self, input_peer, txid, vout):
+        """ Store the commitment transaction found for an input peer. """
+        self._index(input_peer, 'txid', txid)
+        input_peer['tx_vout'] = vout
+
     def addInputPeer(self):
         index = self._getLowestFreeSlot()
         if (index is not None):
             escrow = self._escrow_addresses[index]
             escrow['flagged'] = True
-            self._unseen_tx_escrow_addresses.append(escrow['address'])
+            self._commitments.expect(escrow['address'])
             self._number_peers += 1
             return escrow
         else:
@@ -84,19 +118,21 @@ class InputPeerState():
         self._input_peers_frozen = True
         self._assigned_escrows = [escrow for escrow in self._escrow_addresses if (escrow['flagged'])]
         if (self._rank == 0):
-            self._partially_decrypted_addresses = [a for a in self._encrypted_output_addresses]
+            self._partially_decrypted_addresses = list(self._encrypted_output_addresses)
         else:
             self._partially_decrypted_addresses = [None] * len(self._assigned_escrows)
         return self._assigned_escrows
 
     def storeGeneratedEscrow(self, index, public_key, bitcoin_address):
-        self._escrow_addresses.append({
+        input_peer = {
             'id'           : index,
             'address'      : bitcoin_address,
+            'script_pubkey': computeScriptPubKey(public_key),  # Output script (hex) paying to the escrow
             'output'       : None,  # Hold assigned decrypted output address
             'pubkey'       : public_key,
             'txid'         : None,  # Transaction ID from commitment transaction
             'tx_confirmed' : False,  # States whether the transaction has been confirmed sufficiently often
+            'tx_height'    : None,  # Height of the block in which the transaction got sufficiently many confirmations
             'session_id'   : None,
             'flagged'      : False,
             'pending'      : [],
@@ -105,7 +141,9 @@ class InputPeerState():
             'secret_deferred' : Deferred(),
             'split'        : None,
             'hash_share'   : Deferred()
-        })
+        }
+        self._escrow_addresses.append(input_peer)
+        self._indexes['address'][bitcoin_address] = input_peer
         return
 
     def getAssignedEscrows(self):
@@ -118,7 +156,7 @@ class InputPeerState():
         return self._number_peers
 
     def getSessionErrors(self, session_id):
-        return next((error for error in self._session_errors if (error['session_id'] == session_id)), None)
+        return self._session_error_index.get(session_id, None)
 
     def createSessionError(self, session_id, rank, error):
         session_error = self.getSessionErrors(session_id)
@@ -128,6 +166,7 @@ class InputPeerState():
                 'errors'     : []
             }
             self._session_errors.append(session_error)
+            self._session_error_index[session_id] = session_error
         session_error['errors'].append({'rank' : rank, 'error' : error})
         return
 
@@ -157,11 +196,11 @@ class InputPeerState():
             self.createSessionError(session_id, rank)
             return (False, 'output_missing')
 
-        input_peer['session_id'] = session_id
+        self.setSessionID(input_peer, session_id)
         self.addOutputAddress(encrypted_output_address)
         input_peer['flagged'] = True
         self._number_peers += 1
-        self._unseen_tx_escrow_addresses.append(input_peer['address'])
+        self._commitments.expect(input_peer['address'])
         return True, None
 
     def clearReports(self, input_peer_id):
@@ -0,0 +1,90 @@
+""" CoinParty - Round Manager
+    Keeps the states of the concurrently running mixing rounds of one mixnet.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+
+class RoundManager(object):
+    """ Mixing rounds of one mixnet are pipelined: the commitment window of
+        round k+1 opens once round k stops accepting input peers, as long as
+        at most concurrent_rounds rounds are running. All rounds share the
+        mixnet's peer connections; messages carry their round in the header
+        and are routed to the respective state by the P2P endpoints. """
+
+    def __init__(self, state, concurrent_rounds=1):
+        self._template = state  # Rounds are renewed from the newest started state
+        self._states = {state.getRound() : state}
+        self._concurrent_rounds = concurrent_rounds
+        self._started = state.getRound()  # Newest round started locally
+        self._running = 1
+        self._requested = False
+
+    def getConcurrentRounds(self):
+        return self._concurrent_rounds
+
+    def getNewestRound(self):
+        return self._started
+
+    def getState(self, round):
+        """ Return the state of a running round, or None if the round is
+            concluded or unknown. Other peers may start the next round
+            slightly before we do, hence states of rounds that we are about
+            to start are created upon their first message. """
+        state = self._states.get(round, None)
+        if (state is None and self._started < round <= self._started + self._concurrent_rounds):
+            state = self._template.renew(round)
+            self._states[round] = state
+        return state
+
+    def getStates(self):
+        return [self._states[round] for round in sorted(self._states.keys())]
+
+    def requestRound(self):
+        """ Mark that the next round should be started as soon as the
+            pipeline has room for it. Returns whether this is the case
+            already. """
+        self._requested = True
+        return (self._running < self._concurrent_rounds)
+
+    def startRound(self):
+        """ Start the requested round and return its state. """
+        if (not self._requested):
+            raise RuntimeError('round_not_requested')
+        state = self.getState(self._started + 1)
+        self._template = state  # Do not keep older rounds alive
+        self._started += 1
+        self._running += 1
+        self._requested = False
+        return state
+
+    def concludeRound(self, state, until=None):
+        """ Drop the state of a concluded round. If the Deferred until is
+            given, the state keeps receiving the messages of its round until
+            it fires, e.g., while the fees of its output transactions may
+            still be bumped. The round no longer counts as running, though.
+            Returns whether a requested round can be started now. """
+        if (until is None):
+            del self._states[state.getRound()]
+        else:
+            until.addBoth(self._drop, round=state.getRound())
+        self._running -= 1
+        return self._requested
+
+    def _drop(self, v, round):
+        self._states.pop(round, None)
+        return v
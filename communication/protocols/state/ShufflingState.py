@@ -20,18 +20,29 @@
 
 from twisted.internet.defer import Deferred
 
+from ..low.constants import hash_order
+from ..low.AddressArray import AddressArray
+
 
 class ShufflingState():
 
     def __init__(self, number_mixpeers):
         self._checksums = [None] * number_mixpeers
         self._addr_deferreds = [Deferred() for i in xrange(number_mixpeers)]
+        self._addr_chunks = [None] * number_mixpeers
+        self._addr_chunk_callbacks = []
+        self._reference_checksums = [0] * number_mixpeers
+        self._reference_entries = [0] * number_mixpeers
+        self._hash_share_sums = None
+        self._checksums_deferred = None  # Set if all checksums are opened at once
         self._shuffling_deferred = Deferred()
         self._initialize_deferred = Deferred()
+        self._chunks_initialize_deferred = Deferred()
 
     """ The checksum as constructed from hashshares. """
 
     def initialized(self):
+        self._chunks_initialize_deferred.callback(None)
         self._initialize_deferred.callback(None)
 
     def storeChecksums(self, checksums):
@@ -45,6 +56,51 @@ class ShufflingState():
     def getChecksum(self, index=-1):
         return self._checksums[index]
 
+    def storeHashShareSums(self, sums):
+        """ Store the sum of all escrows' hash shares for each layer. """
+        self._hash_share_sums = sums
+        return
+
+    def getHashShareSum(self, layer):
+        return None if (self._hash_share_sums is None) else self._hash_share_sums[layer]
+
+    def setChecksumsDeferred(self, deferred):
+        self._checksums_deferred = deferred
+        return
+
+    def getOpenedChecksum(self, index):
+        """ If all checksums are opened at once, return a Deferred firing with
+            the checksum of the given layer once they are. Otherwise, None. """
+        if (self._checksums_deferred is None):
+            return None
+        d = Deferred()
+
+        def _fire(v):
+            d.callback(self._checksums[index])
+            return v
+
+        def _fail(f):
+            d.errback(f)
+            return f
+
+        self._checksums_deferred.addCallbacks(_fire, _fail)
+        return d
+
+    """ The reference checksum as constructed from the received addresses. """
+
+    def foldReferenceChecksum(self, rank, checksum, number_entries):
+        """ Add the checksum of some entries of a peer's addr broadcast. """
+        self._reference_checksums[rank] = (self._reference_checksums[rank] + checksum) % hash_order
+        self._reference_entries[rank] += number_entries
+        return
+
+    def getReferenceChecksum(self, rank, number_entries):
+        """ Return the reference checksum of a peer's addr broadcast, or None
+            if not exactly number_entries entries have been folded into it. """
+        if (self._reference_entries[rank] != number_entries):
+            return None
+        return self._reference_checksums[rank]
+
     def receivedAddrBroadcast(self, addresses, rank):
         def _fire_addr_deferred(_, rank):
             d = self._addr_deferreds[rank]
@@ -59,6 +115,34 @@ class ShufflingState():
             d.addCallback(cb)
         return
 
+    """ Chunks of addr broadcasts """
+
+    def receivedAddrChunk(self, addresses, rank, chunk, chunks):
+        """ Store a chunk of the addr broadcast of a mixing peer and inform
+            the chunk callbacks about it. Return the whole array once all
+            its chunks have been received, otherwise None. """
+        def _fire_chunk_callbacks(v):
+            for cb in self._addr_chunk_callbacks:
+                cb(addresses, rank, chunk, chunks)
+            return v
+
+        if (self._addr_chunks[rank] is None):
+            self._addr_chunks[rank] = [None] * chunks
+        received = self._addr_chunks[rank]
+        if (len(received) != chunks or received[chunk] is not None):  # Ignore duplicate/inconsistent chunks
+            return None
+        received[chunk] = addresses
+        self._chunks_initialize_deferred.addCallback(_fire_chunk_callbacks)
+        if (None in received):
+            return None
+        return AddressArray.concatenate(received)
+
+    def addAddrChunkCallback(self, cb):
+        """ cb is called as cb(addresses, rank, chunk, chunks) for each
+            received chunk of an addr broadcast. """
+        self._addr_chunk_callbacks.append(cb)
+        return
+
     def getShufflingDeferred(self):
         return self._shuffling_deferred
 
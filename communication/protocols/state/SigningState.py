@@ -0,0 +1,95 @@
+""" CoinParty - Signing State
+    Contains state variables that are relevant to the distributed signing of
+    transactions.
+
+    Copyright (C) 2016 Roman Matzutt, Henrik Ziegeldorf
+
+    This file is part of CoinParty.
+
+    CoinParty is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CoinParty is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CoinParty.  If not, see <http://www.gnu.org/licenses/>. """
+
+
+class SigningState():
+    """ Allocate the SMPC values that open signatures for signing sessions.
+        Sessions are numbered per mixnet in the order they are opened. As
+        all mixing peers open sessions in the same order, they agree on the
+        (id, index) pair of each session without any communication, no
+        matter how many sessions run concurrently.
+        Additionally, the signing contexts of each escrow are kept here, i.e.,
+        everything about its nonces k that does not depend on the message.
+        Each escrow has nonces_per_escrow nonces, each of which must be used
+        for one signature only.
+        Finally, script templates (e.g., the output script of each escrow)
+        are cached here, as they are needed for every transaction. """
+
+    def __init__(self, nonces_per_escrow=1, smpc_id='S'):
+        self._nonces_per_escrow = nonces_per_escrow
+        self._smpc_id = smpc_id
+        self._next_index = 0
+        self._open_sessions = dict()  # index -> description of the signing job
+        self._contexts = dict()  # nonce index -> signing context
+        self._scripts = dict()  # key -> script template
+
+    def openSession(self, description=None):
+        """ Return the (id, index) pair to be used for a new signing session. """
+        index = self._next_index
+        self._next_index += 1
+        self._open_sessions[index] = description
+        return (self._smpc_id, index)
+
+    def closeSession(self, session):
+        (_, index) = session
+        self._open_sessions.pop(index, None)
+        return
+
+    def getOpenSessions(self):
+        return [(self._smpc_id, index) for index in sorted(self._open_sessions.keys())]
+
+    def getNumberOpenedSessions(self):
+        return self._next_index
+
+    def getNoncesPerEscrow(self):
+        return self._nonces_per_escrow
+
+    def getNonceIndex(self, escrow_index, nonce):
+        """ Return the SMPC index of the values belonging to an escrow's nonce. """
+        if (nonce >= self._nonces_per_escrow):
+            raise RuntimeError('nonces_exhausted')
+        return escrow_index * self._nonces_per_escrow + nonce
+
+    def storeContext(self, nonce_index, R, r, k_inv_share, r_k_inv_d_share):
+        """ Store the signing context of a nonce. R is the nonce point kG,
+            r = R.x mod n, and the shares are those of k^-1 and r * k^-1 * d. """
+        self._contexts[nonce_index] = {
+            'R'    : R,
+            'r'    : r,
+            'ki'   : k_inv_share,
+            'rkid' : r_k_inv_d_share
+        }
+        return
+
+    def getContext(self, escrow_index, nonce=0):
+        try:
+            return self._contexts[self.getNonceIndex(escrow_index, nonce)]
+        except KeyError:
+            raise RuntimeError('signing_context_missing')
+
+    def getScript(self, key, create):
+        """ Return the cached script template for key. If there is none
+            yet, it is created by calling create(). """
+        script = self._scripts.get(key)
+        if (script is None):
+            script = create()
+            self._scripts[key] = script
+        return script
@@ -17,7 +17,7 @@ BASE_PORT_WEB = 8000
 BASE_PORT_P2P = 10000
 MIXNET_NAME = 'sample_mixnet'
 
-mixnet_config = {'global_config' : {'testnet' : 'True'}, 'mixing_peers' : {}, 'mixing_networks' : {MIXNET_NAME : {}}}
+mixnet_config = {'global_config' : {'testnet' : 'True', 'watch_addresses' : 'False', 'nonces_per_escrow' : '1', 'batch_interval' : '0', 'fee_bump_blocks' : '0', 'open_checksums_early' : 'False', 'concurrent_rounds' : '1', 'history_size' : '16', 'archive_dir' : '', 'decryption_workers' : '0'}, 'mixing_peers' : {}, 'mixing_networks' : {MIXNET_NAME : {}}}
 
 for mp in xrange(MIXNET_SIZE):
     mp_id = 'mp{0:02d}'.format(mp)